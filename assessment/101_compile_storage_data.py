@@ -24,21 +24,17 @@ from pandas_indexing import ismatch
 
 from pathlib import Path
 
+from utils import RegionMatrix, read_excel_cached, write_derived
+
 # %%
 data_path = Path('../data/packaged')
 write_path = Path('../data/derived')
 
 
 # %%
-def cols_to_dict(df, col1, col2):
-    keys = df[col1].unique()
-    df = df.set_index(col1)
-    return {key: df[col2][key].to_list() for key in keys}
-
+# all region definitions of the mapping are compiled into one sparse region x country matrix
 mdf = pd.read_csv(data_path / 'iso3c_region_mapping_20240602.csv')
-r5_mapping = cols_to_dict(mdf.dropna(subset='r5_iamc'), 'r5_iamc', 'iso3c')
-r10_mapping = cols_to_dict(mdf.dropna(subset='r10_iamc'), 'r10_iamc', 'iso3c')
-w_mapping = {'World': mdf.iso3c.unique()}
+regions = RegionMatrix(mdf)
 
 mdf.head()
 
@@ -56,22 +52,18 @@ df.head()
 
 
 # %%
-def aggregate(df, mapping):
-    df = df.pix.aggregate(ISO=mapping, mode='return')
+def aggregate(df, schemes):
+    df = regions.aggregate(df, schemes)
     df['Percentage lost (net vs gross)'] = 1 - df['Pot_Final'] / df['Pot_Baseline']
-    return df.rename_axis(index={'ISO': 'Region'})
+    return df
 
-data = pd.concat([
-    aggregate(df, r5_mapping),
-    aggregate(df, r10_mapping),
-    aggregate(df, w_mapping),
-])
+data = aggregate(df, ['r5_iamc', 'r10_iamc', 'World']).droplevel('scheme')
 
 data
 
 # %%
 # we have to replace non-oil and gas with world values which include antartica and non-EEZ areas
-wdf = pd.read_excel(data_path / 'Sensitivity_table_20240602.xlsx', sheet_name='data')
+wdf = read_excel_cached(data_path / 'Sensitivity_table_20240602.xlsx', sheet_name='data')
 wdf
 
 # %%
@@ -89,6 +81,17 @@ data
 # %%
 data.to_csv(write_path / '101_Analysis_dataset_r5_r10.csv', index=True)
 
+# %% [markdown]
+# # Storage potentials for all region definitions in the mapping
+
+# %%
+# every scheme (r5_iamc, r10_message, r12_remind, r22_ipcc, ...) in one pass, indexed by (scheme, Region)
+all_data = aggregate(df, regions.schemes)
+all_data.loc[('World', 'World')] = data.loc['World']
+write_derived(all_data, write_path / '101_Analysis_dataset_all_regions.feather')
+
+all_data.groupby('scheme', sort=False).size()
+
 # %% [markdown]
 # # Limits file used in subsequent analysis
 
@@ -15,7 +15,6 @@
 
 # %%
 import pandas as pd
-import numpy as np
 import seaborn as sns
 import matplotlib.pyplot as plt
 
@@ -24,18 +23,13 @@ import pyam
 
 from pathlib import Path
 
-
-# %%
-def read_vars(fname, vars=[]):
-    df = pd.read_csv(fname)
-    df = df[df.Variable.isin(vars)]
-    return df
-
+from utils import IAMC_LEVELS, SparseTimeseries, read_all_vars, read_excel_cached, value_at_net_zero, write_derived
 
 # %%
 data_path = Path('../data/packaged')
 write_path = Path('../data/derived')
 raw_path = Path('../data/raw')
+cache_path = write_path / 'ar6_cache' # parquet copies of the AR6 snapshots, rebuilt when a snapshot changes
 
 # %%
 fnames = [
@@ -44,7 +38,14 @@ fnames = [
     raw_path / 'AR6_Scenarios_Database_R10_regions_v1.1.csv',
     ]
 
-data = [read_vars(fname, vars=['Carbon Sequestration|CCS', 'Carbon Sequestration|CCS|Fossil']) for fname in fnames]
+# files are read in parallel, set max_memory (bytes per worker) on constrained nodes
+data = read_all_vars(
+    fnames,
+    max_workers=len(fnames),
+    max_memory=None,
+    vars=['Carbon Sequestration|CCS', 'Carbon Sequestration|CCS|Fossil'],
+    cache=cache_path,
+)
 
 # %%
 levels = ['Model', 'Scenario']
@@ -76,57 +77,49 @@ check['Has R10'].value_counts()
 # # Now we interpolate, add cumulative variables, and set values at net-zero
 
 # %%
-df = pyam.IamDataFrame(pd.concat(data)).interpolate(range(2010, 2101))
+# timeseries stay on their reported year grid, annual values are only evaluated where they are needed
+sdf = SparseTimeseries(pd.concat(data).set_index(IAMC_LEVELS).rename(columns=int))
+years = range(2010, 2101)
 
 # %%
-df.filter(region='World', scenario='EMF33_Med2C_cost100').plot.line(color='variable')
+pyam.IamDataFrame(sdf.filter(Region='World', Scenario='EMF33_Med2C_cost100').interpolate(years)).plot.line(color='variable')
 
 
 # %%
-def make_cumulative_df(df, vold, vnew, offset=False):
+def make_cumulative_df(sdf, variables, offset=False, method='step'):
     y1 = offset or 2010
     y2 = 2100
-    data = df.filter(variable=vold).interpolate(range(y1, y2 + 1))
-    if offset:
-        data = data.offset(year=y1) # NB this fails if there is no value in the year
-    pddata = (
-        data
-        .filter(year=range(y1, y2 + 1))
-        .rename(variable={vold: vnew})
-        .timeseries()
-    )
-    ret = pyam.IamDataFrame(pddata.cumsum(axis=1))
-    ret.set_meta(data.meta)
-    return ret
+    data = sdf.filter(Variable=list(variables))
+    # all variables are integrated at once, NB offset gives NaN if there is no value in the year
+    ts = data.cumulative(start=y1, end=y2, method=method, offset=bool(offset))
+    return ts.rename(index=variables, level='Variable')
 
 
 # %%
-cdf = pyam.concat([
-    make_cumulative_df(df, vold='Carbon Sequestration|CCS', vnew='Cumulative Carbon Sequestration|CCS'),
-    make_cumulative_df(df, vold='Carbon Sequestration|CCS|Fossil', vnew='Cumulative Carbon Sequestration|CCS|Fossil'),
-])
+cdf = make_cumulative_df(sdf, variables={
+    'Carbon Sequestration|CCS': 'Cumulative Carbon Sequestration|CCS',
+    'Carbon Sequestration|CCS|Fossil': 'Cumulative Carbon Sequestration|CCS|Fossil',
+})
 
 # %%
-data = pyam.concat([df, cdf])
+data = pd.concat([sdf.interpolate(years), cdf]).sort_index()
 data.to_csv(write_path / '102_ccs_data_r5_r10.csv')
+write_derived(data, write_path / '102_ccs_data_r5_r10.feather')
 
 
 # %%
-data.load_meta(raw_path / 'AR6_Scenarios_Database_metadata_indicators_v1.1.xlsx')
+meta = read_excel_cached(raw_path / 'AR6_Scenarios_Database_metadata_indicators_v1.1.xlsx', categorical=['Category'], sheet_name='meta', index_col=list(range(2)))
 
 
 # %%
-def value_at_net_zero(row, nz):
-    year = nz.loc[row.name[0], row.name[1]]
-    return row[year] if np.isfinite(year) else np.nan
-
-nz = data.meta['Year of netzero CO2 emissions (Harm-Infilled) Table SPM2']
-nz_co2 = data.timeseries().apply(value_at_net_zero, args=(nz,), axis=1).pix.assign(year=-1) # NB: net-zero co2 year is set to -1
-
-nz = data.meta['Year of netzero GHG emissions (Harm-Infilled) Table SPM2']
-nz_ghg = data.timeseries().apply(value_at_net_zero, args=(nz,), axis=1).pix.assign(year=-2) # NB: net-zero ghg year is set to -2
+nz_data = value_at_net_zero(data, meta, {
+    'Year of netzero CO2 emissions (Harm-Infilled) Table SPM2': -1, # NB: net-zero co2 year is set to -1
+    'Year of netzero GHG emissions (Harm-Infilled) Table SPM2': -2, # NB: net-zero ghg year is set to -2
+})
 
-pyam.IamDataFrame(pd.concat([nz_co2, nz_ghg])).to_csv(write_path / '102_netzero_ccs_data_r5_r10.csv')
+nz_data = pyam.IamDataFrame(nz_data)
+nz_data.to_csv(write_path / '102_netzero_ccs_data_r5_r10.csv')
+write_derived(nz_data.timeseries().rename_axis(index=str.capitalize), write_path / '102_netzero_ccs_data_r5_r10.feather')
 
 
 # %% [markdown]
@@ -134,7 +127,7 @@ pyam.IamDataFrame(pd.concat([nz_co2, nz_ghg])).to_csv(write_path / '102_netzero_
 
 # %%
 data = pyam.IamDataFrame(write_path / '102_netzero_ccs_data_r5_r10.csv')
-data.load_meta(raw_path / 'AR6_Scenarios_Database_metadata_indicators_v1.1.xlsx')
+data.set_meta(meta.astype({'Category': object}).rename_axis(index=str.lower))
 
 ax = (
     data
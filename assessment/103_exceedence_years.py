@@ -19,20 +19,23 @@ import numpy as np
 import seaborn as sns
 import matplotlib.pyplot as plt
 
+import inspect
 import pyam
 
 from pathlib import Path
-from pandas_indexing import ismatch, isin
+
+from utils import cached_artifact, data_hash, exceedance_sweep, exceedance_table, read_derived, read_excel_cached
 
 # %%
 data_path = Path('../data/derived')
+packaged_path = Path('../data/packaged')
 
 # %%
 regions = ['R5ASIA', 'R5LAM', 'R5MAF', 'R5OECD90+EU', 'R5REF', 'World']
 
 # %%
-cdf = pd.read_csv(data_path / '102_ccs_data_r5_r10.csv', index_col=list(range(5)))
-zdf = pd.read_csv(data_path / '102_netzero_ccs_data_r5_r10.csv', index_col=list(range(5))).rename(columns={'-2': 'Net Zero GHGs', '-1': 'Net Zero CO2'})
+cdf = read_derived(data_path / '102_ccs_data_r5_r10.feather')
+zdf = read_derived(data_path / '102_netzero_ccs_data_r5_r10.feather').rename(columns={-2: 'Net Zero GHGs', -1: 'Net Zero CO2'})
 limits = pd.read_csv(data_path / '101_Analysis_dataset_r5_r10.csv').set_index('Region')
 
 # %%
@@ -52,51 +55,79 @@ make_limit(limits, 'World')
 
 
 # %%
-# year that limit is reached after achieving net-zero CO2 emissions globally
-def calc_time_to_limit(value, note, df):
-    limit = value * 1e3
-    nz_value = df.loc[ismatch(Variable='Cumulative Carbon Sequestration|CCS'), 'Net Zero CO2'].reset_index(level=['Variable'], drop=True)
-    nz_rate= df.loc[ismatch(Variable='Carbon Sequestration|CCS'), 'Net Zero CO2'].reset_index(level=['Variable'], drop=True)
-    return ((limit - nz_value) / nz_rate).pix.assign(**{hue_label: note})
-
-nzdf = []
-for region in regions:
-    time_to_limit = pd.concat([calc_time_to_limit(row['value'], row['note'], zdf.loc[ismatch(Region=region)]) for i, row in make_limit(limits, region).iterrows()])
-    nzdf.append(time_to_limit.to_frame(name='Years to Exceed at Net-zero CO2 Levels'))
-nzdf = pd.concat(nzdf).reset_index(['Unit'], drop=True)
-
-nzdf
-
+limit_table = pd.concat({region: make_limit(limits, region) for region in regions}, names=['Region'])
+limit_table
 
 # %%
-# year of exceedence extrapolating 
-def calc_time_to_limit(value, note, df):
-    limit = value * 1e3
-    nz_value = df.loc[ismatch(Variable='Cumulative Carbon Sequestration|CCS'), 'Net Zero CO2'].reset_index(level=['Variable'], drop=True)
-    nz_rate= df.loc[ismatch(Variable='Carbon Sequestration|CCS'), 'Net Zero CO2'].reset_index(level=['Variable'], drop=True)
-    return ((limit - nz_value) / nz_rate).pix.assign(**{hue_label: note})
-
-def calc_year_exceedance(value, note, df):
-    limit = value * 1e3
-    ydf = df.loc[ismatch(Variable='Cumulative Carbon Sequestration|CCS')].copy() 
-    ydf.columns = ydf.columns.astype(int)
-    ydf[list(range(2101, 2301))] = np.nan
-    extrap_ydf = ydf.interpolate(method="slinear", fill_value="extrapolate", limit_direction="both", axis=1)
-    year_exceedance = (extrap_ydf > limit).idxmax(axis=1)
-    year_exceedance[year_exceedance == 1990] = np.nan
-    return year_exceedance.pix.assign(**{hue_label: note})
-
-
-exdf = []
-for region in regions:
-    year_exceedance = pd.concat([calc_year_exceedance(row['value'], row['note'], df=cdf.loc[ismatch(Region=region)]) for i, row in make_limit(limits, region).iterrows()])
-    exdf.append(year_exceedance.to_frame(name='Exceedance Year'))
-exdf = pd.concat(exdf).reset_index(['Variable', 'Unit'], drop=True)
+# years to reach each limit at net-zero CO2 levels and year of exceedence extrapolating beyond 2100
+# all regions and thresholds are evaluated at once
+horizon = 2300
+
+def write_exceedance(path):
+    exceedance = exceedance_table(
+        cdf,
+        zdf,
+        limit_table.assign(value=lambda df: df['value'] * 1e3), # Gt to Mt
+        label=hue_label,
+        horizon=horizon,
+    )
+    exceedance.to_csv(path, index=True)
+
+inputs = [
+    data_path / '102_ccs_data_r5_r10.feather',
+    data_path / '102_netzero_ccs_data_r5_r10.feather',
+    data_path / '101_Analysis_dataset_r5_r10.csv',
+    Path('utils.py'),
+]
+# the key covers the frames as prepared in this notebook, not only the files they are read from
+cached_artifact(
+    data_path / '103_exceedence_years.csv',
+    write_exceedance,
+    inputs=inputs,
+    params={
+        'regions': regions,
+        'horizon': horizon,
+        'label': hue_label,
+        'data': data_hash(cdf, zdf, limit_table),
+    },
+)
+exceedance = pd.read_csv(data_path / '103_exceedence_years.csv', index_col=list(range(4)))
+exceedance
+
+# %% [markdown]
+# # Sensitivity to the global storage limit
 
-exdf
+# %%
+# each exclusion layer of the sensitivity table is applied to the technical potential with 50% chance
+def sample_limits(stable, n, seed=0):
+    rng = np.random.default_rng(seed)
+    layers = stable['Total'].iloc[1:-1].to_numpy()
+    applied = rng.random((n, len(layers))) < 0.5
+    return pd.DataFrame(
+        {'World': stable['Total'].iloc[0] - applied @ layers},
+        index=pd.RangeIndex(n, name='sample'),
+    )
 
+stable = read_excel_cached(packaged_path / 'Sensitivity_table_20240602.xlsx', sheet_name='data')
+sample_limits(stable, n=10_000).describe()
 
 # %%
-nzdf.join(exdf).to_csv(data_path / '103_exceedence_years.csv', index=True)
+# quantiles over scenarios are streamed per chunk of samples, the full scenario x sample cube is never held
+nsamples, seed = 10_000, 0
+
+def write_sweep(path):
+    samples = sample_limits(stable, n=nsamples, seed=seed)
+    sweep = pd.concat(exceedance_sweep(cdf, zdf, samples * 1e3, chunksize=500, horizon=horizon)) # Gt to Mt
+    sweep.to_csv(path, index=True)
+
+cached_artifact(
+    data_path / '103_exceedence_sensitivity.csv',
+    write_sweep,
+    inputs=inputs + [packaged_path / 'Sensitivity_table_20240602.xlsx'],
+    params={'n': nsamples, 'seed': seed, 'horizon': horizon, 'data': data_hash(cdf, zdf, stable)},
+    code=inspect.getsource(sample_limits) + inspect.getsource(write_sweep),
+)
+sweep = pd.read_csv(data_path / '103_exceedence_sensitivity.csv', index_col=list(range(4)))
+sweep
 
 # %%
@@ -23,6 +23,8 @@ import pyam
 from pathlib import Path
 from pandas_indexing import ismatch
 
+from utils import read_excel_cached
+
 # %%
 sns.set_style('whitegrid')
 
@@ -39,7 +41,7 @@ levels = ['Model', 'Scenario', 'Region', 'Variable', 'Unit']
 
 df = (
     pyam.IamDataFrame(
-        pd.read_excel(packaged_path / 'diagram_trajectories.xlsx').set_index(levels).pix.assign(Unit='Gt CO2/yr') * 1e-3
+        read_excel_cached(packaged_path / 'diagram_trajectories.xlsx').set_index(levels).pix.assign(Unit='Gt CO2/yr') * 1e-3
     )
     .interpolate(range(2015, 2101))
     )
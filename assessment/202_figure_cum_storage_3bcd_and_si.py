@@ -15,7 +15,6 @@
 
 # %%
 import pandas as pd
-import numpy as np
 import seaborn as sns
 import matplotlib.pyplot as plt
 
@@ -24,6 +23,11 @@ import pyam
 from pathlib import Path
 from pandas_indexing import ismatch, isin
 
+from utils import (
+    Ensemble, box_stats, cached_artifact, data_hash, draw_boxes, draw_violins, kde_stats, read_derived,
+    read_excel_cached, render_figures, write_derived,
+)
+
 # %%
 data_path = Path('../data/derived')
 raw_path = Path('../data/raw')
@@ -58,10 +62,8 @@ label_mapping = {
 #    'C5': '2.5°C (>50%)',
 }
 
-def add_label_mapping(df, drop=False):
-    df[cat_label] = df['Category'].replace(label_mapping)
-    if drop:
-        df.drop(df[~df['Category'].isin(label_mapping.keys())].index, inplace=True)
+def add_label_mapping(df):
+    df[cat_label] = df['Category'].map(lambda c: label_mapping.get(c, c))
 
 
 # %% [markdown]
@@ -84,19 +86,16 @@ def add_spans(ax, limits, orient='h'):
 
 
 # %%
-cdf = pd.read_csv(data_path / '102_ccs_data_r5_r10.csv', index_col=list(range(5))).rename(columns={'2100': 'End of Century'})
-zdf = pd.read_csv(data_path / '102_netzero_ccs_data_r5_r10.csv', index_col=list(range(5))).rename(columns={'-2': 'Net Zero GHGs', '-1': 'Net Zero CO2'})
-mdf = pd.read_excel(raw_path / 'AR6_Scenarios_Database_metadata_indicators_v1.1.xlsx', sheet_name='meta', index_col=list(range(2)))
+cdf = read_derived(data_path / '102_ccs_data_r5_r10.feather').rename(columns={2100: 'End of Century'})
+zdf = read_derived(data_path / '102_netzero_ccs_data_r5_r10.feather').rename(columns={-2: 'Net Zero GHGs', -1: 'Net Zero CO2'})
+mdf = read_excel_cached(raw_path / 'AR6_Scenarios_Database_metadata_indicators_v1.1.xlsx', categorical=['Category'], sheet_name='meta', index_col=list(range(2)))
 
 # %%
-data = (
-    pd.concat((cdf['End of Century'], zdf[['Net Zero GHGs', 'Net Zero CO2']]), axis=1)
-    .join(mdf, on=['Model', 'Scenario'])
-    .replace(to_replace={'Category': ['failed-vetting', 'no-climate-assessment']}, value=np.nan)
-    .dropna(subset='Category')
-)
+# selecting the labelled categories also drops unvetted and unassessed scenarios
+ens = Ensemble(pd.concat((cdf['End of Century'], zdf[['Net Zero GHGs', 'Net Zero CO2']]), axis=1), mdf)
+data = ens.filter(Category=list(label_mapping)).frame(meta=['Category'])
 
-add_label_mapping(data, drop=True)
+add_label_mapping(data)
 
 cstor_data = data.melt(id_vars=['Category', cat_label], value_vars=['Net Zero CO2', 'End of Century'], ignore_index=False)
 cstor_data = cstor_data.where(cstor_data.Category.isin(label_mapping.keys()))
@@ -104,7 +103,7 @@ cstor_data.head()
 
 
 # %%
-def plot_cstorage_dist(data, limits, region, ax=None):
+def plot_cstorage_dist(kde, quartiles, limits, region, ax=None):
     sns.set_style("whitegrid")
     if ax is None:
         fig, ax = plt.subplots(figsize=(7, 12))
@@ -114,17 +113,12 @@ def plot_cstorage_dist(data, limits, region, ax=None):
         'End of Century': 'mediumpurple',
     }
 
-    _data = data.loc[ismatch(Region=region, Variable='Cumulative Carbon Sequestration|CCS')].reset_index(drop=True)
-    sns.violinplot(
-            data=_data,
-            y='value',
-            hue='variable',
-            x=cat_label,
+    draw_violins(
+            ax,
+            kde,
+            quartiles,
             order=label_mapping.values(),
-            inner='quart',
-            split=True,
-            cut=0,
-            ax=ax,
+            hue_order=list(palette),
             palette=palette,
             )
 
@@ -137,26 +131,60 @@ def plot_cstorage_dist(data, limits, region, ax=None):
     return ax
 
 
-# %%
-plot_cstorage_dist(cstor_data, limits, 'World')
-
 # %% [markdown]
 # # Exceedence Figs
 
 # %%
 exdf = (
-    pd.read_csv(data_path / '103_exceedence_years.csv', index_col=list(range(4)))
-    .join(mdf['Category'], on=['Model', 'Scenario'])
-    .replace(to_replace={'Category': ['failed-vetting', 'no-climate-assessment']}, value=np.nan)
-    .dropna(subset='Category')
+    Ensemble(pd.read_csv(data_path / '103_exceedence_years.csv', index_col=list(range(4))), mdf)
+    .filter(Category=list(label_mapping))
+    .frame(meta=['Category'])
 )
-add_label_mapping(exdf, drop=True)
+add_label_mapping(exdf)
 exdf = exdf.reset_index(['Model', 'Scenario', 'Threshold'], drop=False)
 exdf
 
+# %%
+# distributions are summarised once per region, category and variable (or threshold), figures only draw the summaries
+# the key covers the frames as prepared above, so any change to the selection or labels recomputes them
+ex_vars = ['Years to Exceed at Net-zero CO2 Levels', 'Exceedance Year']
+thresholds = list(exdf[hue_label].unique())
+
+ccs = cstor_data.loc[ismatch(Variable='Cumulative Carbon Sequestration|CCS')].reset_index()
+ex = exdf.reset_index().melt(id_vars=['Region', cat_label, hue_label], value_vars=ex_vars)
+stats = {
+    '202_violin_kde': (kde_stats, ccs, ['Region', cat_label, 'variable']),
+    '202_violin_quartiles': (box_stats, ccs, ['Region', cat_label, 'variable']),
+    '202_exceedance_box': (box_stats, ex, ['Region', 'variable', cat_label, hue_label]),
+}
+for name, (summarise, df, by) in stats.items():
+    cached_artifact(
+        data_path / f'{name}.feather',
+        lambda path: write_derived(summarise(df, 'value', by), path),
+        inputs=[Path('utils.py')],
+        params={'stat': summarise.__name__, 'by': by, 'labels': label_mapping, 'data': data_hash(df)},
+    )
+
+kde = read_derived(data_path / '202_violin_kde.feather')
+quartiles = read_derived(data_path / '202_violin_quartiles.feather')
+box = read_derived(data_path / '202_exceedance_box.feather')
+box
 
 # %%
-def plot_nz_exceedence(data, x, legend=None, ax=None):
+# summaries of each region are sliced once and shared by all figures (and forked render workers) of the region
+def select(df, key):
+    """Rows of `df` under `key` in its first level, none if it has no statistics there"""
+    return df.loc[key] if key in df.index.unique(0) else df.iloc[:0].droplevel(0)
+
+regions = ['R5ASIA', 'R5LAM', 'R5MAF', 'R5OECD90+EU', 'R5REF']
+slices = {
+    region: (select(kde, region), select(quartiles, region), select(box, region))
+    for region in ['World'] + regions
+}
+
+
+# %%
+def plot_nz_exceedence(box, x, legend=None, ax=None):
     if ax is None:
         FIGSIZE = (10, 3)
         sns.set_style("whitegrid")
@@ -168,48 +196,69 @@ def plot_nz_exceedence(data, x, legend=None, ax=None):
         'high': 'orangered',
     }
 
-    sns.boxplot(
-            data=data,
-            x=x,
-            y=cat_label,
-            hue=hue_label,
-            legend=legend,
+    # groups without finite values have no statistics and leave an empty panel
+    draw_boxes(
+            ax,
+            select(box, x),
             order=label_mapping.values(),
-            showfliers=False,
-            ax=ax,
-            palette=[colors['high'], colors['med'], colors['low']],
+            hue_order=thresholds,
+            palette=dict(zip(thresholds, [colors['high'], colors['med'], colors['low']])),
+            legend=legend,
+            title=hue_label,
             ).set(ylabel='', xlabel='', title=x)
     
     return ax
 
 
 # %%
-plot_nz_exceedence(exdf.loc['World'].reset_index(), legend=True, x='Years to Exceed at Net-zero CO2 Levels')
+plot_cstorage_dist(*slices['World'][:2], limits, 'World')
 
 # %%
-plot_nz_exceedence(exdf.loc['World'].reset_index(), x='Exceedance Year')
+plot_nz_exceedence(slices['World'][2], legend=True, x='Years to Exceed at Net-zero CO2 Levels')
+
+# %%
+plot_nz_exceedence(slices['World'][2], x='Exceedance Year')
 
 # %% [markdown]
 # # Figure 3b-d
 
 # %%
-region = 'World'
-sns.set_style("whitegrid")
+def figure_3b(region):
+    fig, ax = plt.subplots(figsize=(7, 12))
+    plot_cstorage_dist(*slices[region][:2], limits, region, ax=ax)
+    return fig
 
-fig, ax = plt.subplots(figsize=(7, 12))
-plot_cstorage_dist(cstor_data, limits, region, ax=ax)
-fig.savefig(figure_path / 'figure_3b.pdf', bbox_inches='tight', dpi=1e3)
-fig.savefig(figure_path / 'figure_3b.png', bbox_inches='tight', dpi=1e3)
+def figure_3c(region):
+    fig, ax = plt.subplots(figsize=(10, 3))
+    plot_nz_exceedence(slices[region][2], legend=True, x='Years to Exceed at Net-zero CO2 Levels', ax=ax)
+    return fig
 
-fig, ax = plt.subplots(figsize=(10, 3))
-plot_nz_exceedence(exdf.loc[region].reset_index(), legend=True, x='Years to Exceed at Net-zero CO2 Levels', ax=ax)
-fig.savefig(figure_path / 'figure_3c.pdf', bbox_inches='tight', dpi=1e3)
-fig.savefig(figure_path / 'figure_3c.png', bbox_inches='tight', dpi=1e3)
+def figure_3d(region):
+    fig, ax = plt.subplots(figsize=(10, 3))
+    plot_nz_exceedence(slices[region][2], legend=False, x='Exceedance Year', ax=ax)
+    return fig
 
-fig, ax = plt.subplots(figsize=(10, 3))
-plot_nz_exceedence(exdf.loc[region].reset_index(), legend=False, x='Exceedance Year', ax=ax)
-fig.savefig(figure_path / 'figure_3d.pdf', bbox_inches='tight', dpi=1e3)
-fig.savefig(figure_path / 'figure_3d.png', bbox_inches='tight', dpi=1e3)
+# figures are only rendered again if their data, style or plotting code changed
+plot_funcs = [plot_cstorage_dist, plot_nz_exceedence, add_spans, select, draw_violins, draw_boxes]
+figure_data = lambda region: (slices[region], limits.loc[region], label_mapping, thresholds)
+
+# each worker holds a figure of ~120 Mpx at 1000 dpi, so only a few render at a time
+render_workers = 2
+
+sns.set_style("whitegrid")
+figures = {
+    figure_path / f'figure_3{panel}.{ext}': (build, ('World',))
+    for panel, build in {'b': figure_3b, 'c': figure_3c, 'd': figure_3d}.items()
+    for ext in ('pdf', 'png')
+}
+render_figures(
+    figures,
+    data={path: figure_data('World') for path in figures},
+    code=plot_funcs,
+    max_workers=render_workers,
+    bbox_inches='tight',
+    dpi=1e3,
+)
 
 
 # %% [markdown]
@@ -219,9 +268,10 @@ fig.savefig(figure_path / 'figure_3d.png', bbox_inches='tight', dpi=1e3)
 def full_fig(region):
   fig, axs = plt.subplots(3, 1, figsize=(10, 15), height_ratios=[4, 1, 1])
 
-  plot_cstorage_dist(cstor_data, limits, region, ax=axs[0])
-  plot_nz_exceedence(exdf.loc[region].reset_index(), legend=True, x='Years to Exceed at Net-zero CO2 Levels', ax=axs[1])
-  plot_nz_exceedence(exdf.loc[region].reset_index(), x='Exceedance Year', ax=axs[2])
+  kde, quartiles, box = slices[region]
+  plot_cstorage_dist(kde, quartiles, limits, region, ax=axs[0])
+  plot_nz_exceedence(box, legend=True, x='Years to Exceed at Net-zero CO2 Levels', ax=axs[1])
+  plot_nz_exceedence(box, x='Exceedance Year', ax=axs[2])
 
   for i, label in enumerate(('A', 'B', 'C')):
       axs[i].text(-0.1, 1.15, label, transform=axs[i].transAxes,
@@ -233,10 +283,13 @@ def full_fig(region):
 fig = full_fig(region='World')
 
 # %%
-regions = ['R5ASIA', 'R5LAM', 'R5MAF', 'R5OECD90+EU', 'R5REF']
-for region in regions:
-    fig = full_fig(region)
-    fig.savefig(figure_path / f'figure_si_like3_{region}.pdf', bbox_inches='tight', dpi=1e3)
-    fig.savefig(figure_path / f'figure_si_like3_{region}.png', bbox_inches='tight', dpi=1e3)
+# every region and format is rendered in its own process, timings are per figure
+figures = {
+    figure_path / f'figure_si_like3_{region}.{ext}': (full_fig, (region,))
+    for region in regions
+    for ext in ('pdf', 'png')
+}
+data = {path: figure_data(region) for path, (_, (region,)) in figures.items()}
+render_figures(figures, data=data, code=plot_funcs, max_workers=render_workers, bbox_inches='tight', dpi=1e3)
 
 # %%
@@ -21,13 +21,15 @@ from pathlib import Path
 
 import plotnine as p9
 
+from utils import cached_figure, read_excel_cached
+
 
 # %%
 data_path = Path('../data/packaged')
 figure_path = Path('../figures')
 
 # %%
-df = pd.read_excel(data_path / 'Sensitivity_table_20240602.xlsx', sheet_name='data')
+df = read_excel_cached(data_path / 'Sensitivity_table_20240602.xlsx', sheet_name='data')
 df
 
 # %%
@@ -62,16 +64,20 @@ data
 # %%
 colors = {'Offshore': '#7A8EF5', 'Onshore': '#E69800'}
 
-fig = (
-    p9.ggplot(data, p9.aes('cat', 'value', fill='Location'))
-    + p9.geom_rect(data, p9.aes(x='cat', xmin='xmin', xmax='xmax', ymin='ymin', ymax='ymax'))
-    + p9.scale_fill_manual(values=colors)
-    + p9.coord_flip()
-    + p9.ylab('Carbon Storage Potential (Gt CO2)')
-    + p9.xlab('')
-    + p9.theme(figure_size=(8, 5))
-)
-fig.save(figure_path / 'figure_2b.pdf', bbox_inches='tight', dpi=1000)
+def waterfall(data, colors):
+    return (
+        p9.ggplot(data, p9.aes('cat', 'value', fill='Location'))
+        + p9.geom_rect(data, p9.aes(x='cat', xmin='xmin', xmax='xmax', ymin='ymin', ymax='ymax'))
+        + p9.scale_fill_manual(values=colors)
+        + p9.coord_flip()
+        + p9.ylab('Carbon Storage Potential (Gt CO2)')
+        + p9.xlab('')
+        + p9.theme(figure_size=(8, 5))
+    )
+
+fig = waterfall(data, colors)
+# only saved again if the data, colors or plotting code changed
+cached_figure(figure_path / 'figure_2b.pdf', lambda: fig, (data, colors), code=[waterfall], bbox_inches='tight', dpi=1000)
 fig
 
 # %%
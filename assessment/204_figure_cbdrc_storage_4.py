@@ -15,17 +15,24 @@
 
 from pathlib import Path
 
-import numpy as np
-
 # %%
 import pandas as pd
 import plotnine as p9
-import seaborn as sns
-from pandas_indexing import ismatch
+
+from utils import (
+    attribute_emissions,
+    cached_artifact,
+    cached_figure,
+    read_csv_filtered,
+    read_derived,
+    read_excel_cached,
+    write_derived,
+)
 
 # %%
 data_path = Path("../data/packaged")
 raw_path = Path("../data/raw")
+write_path = Path("../data/derived")
 figure_path = Path("../figures")
 
 # %% [markdown]
@@ -48,39 +55,54 @@ sdf.head()
 
 # %%
 # Country-level territorial CO2 in kt
-tdf = pd.read_csv(
-    raw_path / "Guetschow-et-al-2021-PRIMAP-hist_v2.3.1_20-Sep_2021.csv",
-    index_col=list(range(6)),
-)
-tdf = (
-    tdf.loc[
-        ismatch(
-            **{
-                "source": "PRIMAP-hist_v2.3.1",
-                "scenario (PRIMAP-hist)": "HISTTP",  # including 3rd party reporting
-                "entity": "CO2",
-                "category (IPCC2006_PRIMAP)": "M.0.EL",  # national total excl LULUCF
-            }
+primap_file = raw_path / "Guetschow-et-al-2021-PRIMAP-hist_v2.3.1_20-Sep_2021.csv"
+primap_filters = {
+    "source": "PRIMAP-hist_v2.3.1",
+    "scenario (PRIMAP-hist)": "HISTTP",  # including 3rd party reporting
+    "entity": "CO2",
+    "category (IPCC2006_PRIMAP)": "M.0.EL",  # national total excl LULUCF
+}
+years = [str(y) for y in range(1990, 2020)]
+
+
+# filters are applied while streaming the file, the cumulative series are cached
+def write_primap(path):
+    tdf = (
+        read_csv_filtered(
+            primap_file,
+            primap_filters,
+            usecols=["area (ISO3)"] + years,
+            dtype={y: float for y in years},
         )
-    ][pd.Series(range(1990, 2020), dtype=str)]
-    .cumsum(axis=1)
-    .pix.project("area (ISO3)")
-    .rename_axis(index="iso3c", columns="year")
+        .set_index("area (ISO3)")
+        .cumsum(axis=1)
+        .rename_axis(index="iso3c")
+    )
+    write_derived(tdf, path)
+
+
+cached_artifact(
+    write_path / "204_primap_cumulative_co2.feather",
+    write_primap,
+    inputs=[primap_file],
+    params={"filters": primap_filters, "years": years},
 )
+tdf = read_derived(write_path / "204_primap_cumulative_co2.feather", nlevels=1)
+tdf.index = tdf.index.astype(str)
+tdf = tdf.rename_axis(columns="year")
 tdf.head()
 
 # %%
 # country-level carbon major CO2 in Mt
+# emissions are summed per entity and year over integer codes and assigned to countries in one product
 cdf = (
-    pd.merge(
-        pd.read_csv(raw_path / "emissions_low_granularity.csv"),
-        pd.read_excel(data_path / "carbon_major_iso_mapping.xlsx"),
-        left_on="parent_entity",
-        right_on="name",
+    attribute_emissions(
+        pd.read_csv(
+            raw_path / "emissions_low_granularity.csv",
+            usecols=["parent_entity", "year", "total_emissions_MtCO2e"],
+        ),
+        read_excel_cached(data_path / "carbon_major_iso_mapping.xlsx"),
     )
-    .groupby(["iso3c", "year"])["total_emissions_MtCO2e"]
-    .sum()
-    .unstack("year")
     .fillna(method="ffill")[range(1990, 2020)]
     .multiply(1e3)  # Mt to kt
     .cumsum(axis=1)
@@ -90,7 +112,7 @@ cdf.head()
 # %%
 edf = pd.concat(
     [
-        tdf.rename(columns={"2019": "Territorial Emissions (1990-2019)"})[
+        tdf.rename(columns={2019: "Territorial Emissions (1990-2019)"})[
             "Territorial Emissions (1990-2019)"
         ],
         cdf.rename(columns={2019: "Carbon Major Emissions (1990-2019)"})[
@@ -187,10 +209,24 @@ def plot(data, col):
 
 # %%
 p = plot(pdata, tcol)
-p.save(figure_path / "figure_4a.pdf", bbox_inches="tight", dpi=1000)
+cached_figure(
+    figure_path / "figure_4a.pdf",
+    lambda: p,
+    (pdata, tcol),
+    code=[plot],
+    bbox_inches="tight",
+    dpi=1000,
+)
 p
 
 # %%
 p = plot(pdata, ccol)
-p.save(figure_path / "figure_4b.pdf", bbox_inches="tight", dpi=1000)
+cached_figure(
+    figure_path / "figure_4b.pdf",
+    lambda: p,
+    (pdata, ccol),
+    code=[plot],
+    bbox_inches="tight",
+    dpi=1000,
+)
 p
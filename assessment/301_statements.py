@@ -24,6 +24,8 @@ import pyam
 from pathlib import Path
 from pandas_indexing import ismatch, isin
 
+from utils import Ensemble, bootstrap_quantiles, grouped_quantiles, read_derived, read_excel_cached, write_facts
+
 # %%
 data_path = Path('../data/derived')
 raw_path = Path('../data/raw')
@@ -34,31 +36,72 @@ limits
 
 # %%
 
-cdf = pd.read_csv(data_path / '102_ccs_data_r5_r10.csv', index_col=list(range(5))).rename(columns={'2100': 'End of Century'})
-zdf = pd.read_csv(data_path / '102_netzero_ccs_data_r5_r10.csv', index_col=list(range(5))).rename(columns={'-2': 'Net Zero GHGs', '-1': 'Net Zero CO2'})
-mdf = pd.read_excel(raw_path / 'AR6_Scenarios_Database_metadata_indicators_v1.1.xlsx', sheet_name='meta', index_col=list(range(2)))
+cdf = read_derived(data_path / '102_ccs_data_r5_r10.feather').rename(columns={2100: 'End of Century'})
+zdf = read_derived(data_path / '102_netzero_ccs_data_r5_r10.feather').rename(columns={-2: 'Net Zero GHGs', -1: 'Net Zero CO2'})
+mdf = read_excel_cached(raw_path / 'AR6_Scenarios_Database_metadata_indicators_v1.1.xlsx', categorical=['Category'], sheet_name='meta', index_col=list(range(2)))
+
+# %%
+# scenario results and meta are coded once, the queries below only select and materialise slices
+ens = Ensemble(pd.concat((cdf['End of Century'], zdf[['Net Zero GHGs', 'Net Zero CO2']]), axis=1), mdf)
+categories = ['C1', 'C2', 'C3', 'C4']
 
 # %%
 df = (
-    pd.concat((cdf['End of Century'], zdf[['Net Zero GHGs', 'Net Zero CO2']]), axis=1)
-    .loc[ismatch(Region='World')]
-    .pix.assign(Category=mdf['Category'])
-    .loc[isin(Category=['C1', 'C2', 'C3', 'C4'])]
+    ens.filter(Region='World', Category=categories)
+    .frame(meta=['Category'])
+    .set_index('Category', append=True)
     .pix.project(['Variable', 'Category'])
 )
 df.head()
 
+# %%
+# all quantiles used in the statements below, written with the hashes of their sources to a fact file
+quantiles = [0.05, 0.25, 0.5, 0.75, 0.95]
+groupings = [
+    ('Net Zero CO2', ['Variable', 'Category']),
+    ('End of Century', ['Variable']),
+    ('End of Century', ['Variable', 'Category']),
+]
+summaries = {(col, tuple(levels)): grouped_quantiles(df[col], levels, quantiles) for col, levels in groupings}
+
+# %%
+# uncertainty of the quoted ranges: scenarios are resampled per region and category, each model weighted equally
+rdf = (
+    ens.filter(Variable='Carbon Sequestration|CCS', Category=categories)
+    .frame(['End of Century', 'Net Zero CO2'], meta=['Category'])
+    .set_index('Category', append=True)
+)
+bootstrap = {}
+for col in ['Net Zero CO2', 'End of Century']:
+    key = (col, ('Region', 'Category'))
+    summaries[key] = grouped_quantiles(rdf[col], list(key[1]), quantiles)
+    bootstrap[key] = bootstrap_quantiles(rdf[col], list(key[1]), quantiles, n=10_000, weight_by='Model')
+bootstrap[('Net Zero CO2', ('Region', 'Category'))].loc[isin(Region='World')]
+
+# %%
+write_facts(
+    data_path / '301_facts.json',
+    summaries,
+    sources=[
+        data_path / '102_ccs_data_r5_r10.feather',
+        data_path / '102_netzero_ccs_data_r5_r10.feather',
+        raw_path / 'AR6_Scenarios_Database_metadata_indicators_v1.1.xlsx',
+    ],
+    bootstrap=bootstrap,
+)
+
 # %% [markdown]
 # # For the statement
 #
 # > While all scenarios limiting warming below 2°C deploy some level of CCS, some scenarios that intend to strongly revert global warming after weak emission reductions over the next decades utilize up to 2000 Gt of storage by the end of the century.
 
 # %%
-data = (    
-    cdf['End of Century'].loc[isin(Region='World')].unstack('Variable')
+data = (
+    ens.filter(Region='World', Category=categories)
+    .frame('End of Century')
+    .unstack('Variable')
     .join(mdf, on=['Model', 'Scenario'])
     .pix.assign(Category=mdf['Category'])
-    .loc[isin(Category=['C1', 'C2', 'C3', 'C4'])]
     .assign(drawdown=lambda df: df['Median peak warming (MAGICCv7.5.3)'] - df['Median warming in 2100 (MAGICCv7.5.3)'])
     )
 sns.relplot(data=data, x='drawdown', y='Cumulative Carbon Sequestration|CCS', hue='Category')
@@ -74,7 +117,7 @@ data.loc[isin(Category='C2')].plot.scatter(x='drawdown', y='Cumulative Carbon Se
 df.head()
 
 # %%
-df.groupby(level=['Variable', 'Category']).describe([0.05, 0.25, 0.5, 0.75, 0.95])['Net Zero CO2']
+summaries[('Net Zero CO2', ('Variable', 'Category'))]
 
 # %%
 # compared to today
@@ -86,10 +129,10 @@ df.groupby(level=['Variable', 'Category']).describe([0.05, 0.25, 0.5, 0.75, 0.95
 # > In 2100, carbon storage activity is continuing to grow past this limit, with 1.5C and 2C scenarios storing on average 15 [11, 18] Gt CO2yr-1. 
 
 # %%
-df.groupby(level=['Variable']).describe([0.05, 0.25, 0.5, 0.75, 0.95])['End of Century']
+summaries[('End of Century', ('Variable',))]
 
 # %%
-df.groupby(level=['Variable', 'Category']).describe([0.05, 0.25, 0.5, 0.75, 0.95])['End of Century']
+summaries[('End of Century', ('Variable', 'Category'))]
 
 # %% [markdown]
 # # Simple C-budget calcs
@@ -0,0 +1,354 @@
+"""Time and memory-profile the pipeline stages on synthetic AR6-scale data
+
+The AR6 snapshots and the storage potentials are replaced by synthetic files
+with the same schema, sized by the command line options. Each stage is timed
+over `--repeat` runs and run once more under `tracemalloc` for its peak
+memory. Results are appended as json lines, keyed by the git commit, to
+`--output`, so that runs on different commits can be compared.
+
+    $ python benchmark.py                                  # default size
+    $ python benchmark.py --scenarios 3000 --variables 200 # about AR6 size
+    $ python benchmark.py --compare HEAD~3                 # against an earlier run
+    $ python benchmark.py --raw ../data/raw                # only write synthetic raw files
+"""
+
+import argparse
+import json
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from datetime import datetime, timezone
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from utils import (
+    IAMC_LEVELS,
+    RegionMatrix,
+    SparseTimeseries,
+    build_ar6_cache,
+    exceedance_table,
+    library_versions,
+    read_vars,
+    value_at_net_zero,
+)
+
+
+here = Path(__file__).resolve().parent
+packaged = here.parent / 'data' / 'packaged'
+
+# variables read by the pipeline with their unit and scale, other variables are filler
+VARIABLES = {
+    'Carbon Sequestration|CCS': ('Mt CO2/yr', 1),
+    'Carbon Sequestration|CCS|Fossil': ('Mt CO2/yr', 0.6),
+    'Emissions|CO2': ('Mt CO2/yr', -3),
+    'Primary Energy': ('EJ/yr', 0.1),
+}
+SCOPES = {
+    'World': ['World'],
+    'R5': ['R5ASIA', 'R5LAM', 'R5MAF', 'R5OECD90+EU', 'R5REF'],
+    'R10': [
+        'R10AFRICA', 'R10CHINA+', 'R10EUROPE', 'R10INDIA+', 'R10LATIN_AM',
+        'R10MIDDLE_EAST', 'R10NORTH_AM', 'R10PAC_OECD', 'R10REF_ECON', 'R10REST_ASIA',
+    ],
+}
+NETZERO = {
+    'Year of netzero CO2 emissions (Harm-Infilled) Table SPM2': -1,
+    'Year of netzero GHG emissions (Harm-Infilled) Table SPM2': -2,
+}
+
+
+# Synthetic data
+
+def synthetic_ar6(models=10, scenarios=50, regions=('World',), variables=20, years=range(1995, 2101, 5), missing=0.1, seed=0):
+    """Wide frame in the schema of the AR6 snapshot files
+
+    The first `variables` are those of `VARIABLES`, the rest are filler. CCS
+    ramps up from 2020 with a random scale per row and a fraction `missing`
+    of the values is NaN.
+    """
+    rng = np.random.default_rng(seed)
+    names = list(VARIABLES)[:variables] + [f'Filler|{i}' for i in range(variables - len(VARIABLES))]
+    index = pd.MultiIndex.from_product(
+        [[f'Model {i}' for i in range(models)], [f'Scenario {i}' for i in range(scenarios)], list(regions), names],
+        names=['Model', 'Scenario', 'Region', 'Variable'],
+    )
+    variable = index.get_level_values('Variable')
+    units, scales = zip(*(VARIABLES.get(v, ('EJ/yr', 1)) for v in names))
+    codes = pd.Index(names).get_indexer(variable)
+
+    years = np.asarray(years)
+    ramp = np.clip((years - 2020) / (2100 - 2020), 0, None)
+    values = rng.uniform(0, 2000, (len(index), 1)) * (0.05 + ramp) * rng.lognormal(0, 0.1, (len(index), len(years)))
+    values *= np.asarray(scales)[codes, None]
+    values[rng.random(values.shape) < missing] = np.nan
+
+    df = pd.DataFrame(values, index=index, columns=years.astype(str)).reset_index()
+    df.insert(4, 'Unit', np.asarray(units)[codes])
+    return df
+
+
+def synthetic_meta(models=10, scenarios=50, seed=0):
+    """Meta indicators of the scenarios of `synthetic_ar6`, indexed by Model and Scenario"""
+    rng = np.random.default_rng(seed)
+    index = pd.MultiIndex.from_product(
+        [[f'Model {i}' for i in range(models)], [f'Scenario {i}' for i in range(scenarios)]],
+        names=['Model', 'Scenario'],
+    )
+    n = len(index)
+    peak = rng.uniform(1.4, 3, n)
+    return pd.DataFrame(
+        {
+            'Category': rng.choice(['C1', 'C2', 'C3', 'C4', 'C5', 'C6', 'failed-vetting'], n),
+            **{
+                name: rng.choice(np.append(np.arange(2040, 2101, 5, dtype=float), np.nan), n)
+                for name in NETZERO
+            },
+            'Median peak warming (MAGICCv7.5.3)': peak,
+            'Median warming in 2100 (MAGICCv7.5.3)': peak - rng.uniform(0, 0.4, n),
+        },
+        index=index,
+    )
+
+
+def synthetic_mapping(countries=250, seed=0):
+    """Country to region mapping with the columns and region names of the packaged mapping"""
+    rng = np.random.default_rng(seed)
+    template = pd.read_csv(packaged / 'iso3c_region_mapping_20240602.csv')
+    iso = [f'X{i:04d}' for i in range(countries)]
+    mapping = pd.DataFrame({'iso3c': iso, 'm49code': np.arange(countries)})
+    for col in template.columns.drop(['iso3c', 'm49code', 'alpha-3', 'name']):
+        regions = template[col].dropna().unique()
+        mapping[col] = np.where(rng.random(countries) < template[col].notna().mean(), rng.choice(regions, countries), None)
+    return mapping.assign(**{'alpha-3': iso, 'name': iso})
+
+
+def synthetic_storage(mapping, seed=0):
+    """Storage potentials per country in the schema of `Analysis_dataset_20240602.csv`"""
+    rng = np.random.default_rng(seed)
+    n = len(mapping)
+    df = pd.DataFrame({'ISO': mapping['iso3c'].to_numpy()})
+    for kind in ['OFF', 'ON']:
+        baseline = rng.lognormal(1, 2, n) * (rng.random(n) < 0.8)
+        df[f'Pot_{kind}_Baseline'] = baseline
+        df[f'Pot_{kind}_Final'] = baseline * rng.uniform(0, 0.5, n)
+        df[f'Pot_{kind}_OG'] = df[f'Pot_{kind}_Final'] * (rng.random(n) < 0.3)
+    final = df['Pot_OFF_Final'] + df['Pot_ON_Final']
+    baseline = df['Pot_OFF_Baseline'] + df['Pot_ON_Baseline']
+    df['Absolute_Loss'] = baseline - final
+    df['Percentage_Loss'] = (1 - final / baseline).fillna(0)
+    columns = [f'Pot_{k}_{s}' for k in ['OFF', 'ON'] for s in ['Baseline', 'Final', 'OG']]
+    return df[columns + ['ISO', 'Absolute_Loss', 'Percentage_Loss']]
+
+
+def write_raw(path, models=10, scenarios=50, variables=20, missing=0.1, seed=0):
+    """Write synthetic AR6 snapshot and meta files as read by `102` to `path`"""
+    path = Path(path)
+    path.mkdir(parents=True, exist_ok=True)
+    fnames = {
+        'World': path / 'AR6_Scenarios_Database_World_v1.1.csv',
+        'R5': path / 'AR6_Scenarios_Database_R5_regions_v1.1.csv',
+        'R10': path / 'AR6_Scenarios_Database_R10_regions_v1.1.csv',
+    }
+    for i, (scope, fname) in enumerate(fnames.items()):
+        df = synthetic_ar6(models, scenarios, SCOPES[scope], variables, missing=missing, seed=seed + i)
+        df.to_csv(fname, index=False)
+    with pd.ExcelWriter(path / 'AR6_Scenarios_Database_metadata_indicators_v1.1.xlsx') as writer:
+        pd.DataFrame({'Info': ['synthetic meta indicators']}).to_excel(writer, sheet_name='README', index=False)
+        synthetic_meta(models, scenarios, seed).reset_index().to_excel(writer, sheet_name='meta', index=False)
+    return fnames
+
+
+# Stages
+
+def make_limits(regions, scale=1e5, seed=0):
+    """Limits table per (Region, Threshold) as passed to `exceedance_table`"""
+    rng = np.random.default_rng(seed)
+    notes = {'high': 'Global Preventative Limit', 'med': 'Global Onshore Limit', 'low': 'Global Limit with\nCurrent O&G Infrastructure'}
+    index = pd.MultiIndex.from_product([regions, list(notes)], names=['Region', 'Threshold'])
+    return pd.DataFrame(
+        {'value': np.sort(rng.uniform(0, scale, (len(regions), 3)))[:, ::-1].ravel(), 'note': list(notes.values()) * len(regions)},
+        index=index,
+    )
+
+
+def stages(fnames, meta, mapping, storage, cache):
+    """Pipeline stages in order, each a function of the results of the earlier ones"""
+    vars = ['Carbon Sequestration|CCS', 'Carbon Sequestration|CCS|Fossil']
+    cumulative = {
+        'Carbon Sequestration|CCS': 'Cumulative Carbon Sequestration|CCS',
+        'Carbon Sequestration|CCS|Fossil': 'Cumulative Carbon Sequestration|CCS|Fossil',
+    }
+    years = range(2010, 2101)
+    return {
+        # 101
+        'region_aggregate': lambda r: RegionMatrix(mapping).aggregate(storage.set_index('ISO')),
+        # 102
+        'read_vars': lambda r: pd.concat([read_vars(f, vars=vars) for f in fnames]),
+        'build_ar6_cache': lambda r: [build_ar6_cache(f, cache, force=True) for f in fnames],
+        'read_vars_cached': lambda r: pd.concat([read_vars(f, vars=vars, cache=cache) for f in fnames]),
+        'sparse_timeseries': lambda r: SparseTimeseries(r['read_vars'].set_index(IAMC_LEVELS).rename(columns=int)),
+        'interpolate': lambda r: r['sparse_timeseries'].interpolate(years),
+        'cumulative': lambda r: (
+            r['sparse_timeseries'].cumulative(start=2010, end=2100).rename(index=cumulative, level='Variable')
+        ),
+        'value_at_net_zero': lambda r: value_at_net_zero(
+            pd.concat([r['interpolate'], r['cumulative']]).sort_index(), meta, NETZERO
+        ),
+        # 103
+        'exceedance_table': lambda r: exceedance_table(
+            r['cumulative'],
+            r['value_at_net_zero'].unstack('year').rename(columns={-2: 'Net Zero GHGs', -1: 'Net Zero CO2'}),
+            make_limits(r['read_vars']['Region'].unique()),
+            horizon=2300,
+        ),
+    }
+
+
+def measure(func, results, repeat=3, memory=True):
+    """Result, wall times of `repeat` runs and the peak traced memory of one more run of `func`"""
+    seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(results)
+        seconds.append(time.perf_counter() - start)
+    peak = None
+    if memory:
+        tracemalloc.start()
+        try:
+            func(results)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return result, seconds, peak
+
+
+# Results
+
+def git_commit():
+    """Commit of the working tree and whether the assessment code differs from it"""
+    try:
+        commit = subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], cwd=here, capture_output=True, text=True, check=True
+        ).stdout.strip()
+        dirty = subprocess.run(['git', 'diff', '--quiet', 'HEAD', '--', '.'], cwd=here).returncode != 0
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+    return commit, dirty
+
+
+def resolve(rev):
+    """Full commit hash of `rev`"""
+    return subprocess.run(
+        ['git', 'rev-parse', rev], cwd=here, capture_output=True, text=True, check=True
+    ).stdout.strip()
+
+
+def read_results(path):
+    path = Path(path)
+    if not path.exists():
+        return pd.DataFrame()
+    return pd.DataFrame([json.loads(line) for line in path.read_text().splitlines() if line.strip()])
+
+
+def compare(results, base, head, params):
+    """Best time and peak memory of each stage in the latest runs of commits `base` and `head` with `params`"""
+    results = results.loc[results['params'].map(lambda p: p == params)]
+    frames = {}
+    for label, commit in [('base', base), ('head', head)]:
+        runs = results.loc[results['commit'] == commit]
+        if runs.empty:
+            raise ValueError(f'No results for commit {commit} with {params}')
+        latest = runs.loc[runs['run'] == runs['run'].max()].set_index('stage')
+        frames[label] = latest[['best', 'peak_mib']]
+    df = pd.concat(frames, axis=1)
+    df[('ratio', 'best')] = df[('head', 'best')] / df[('base', 'best')]
+    df[('ratio', 'peak_mib')] = df[('head', 'peak_mib')] / df[('base', 'peak_mib')]
+    return df.sort_index(axis=1, level=0, sort_remaining=False)
+
+
+def run(params, repeat=3, memory=True, only=None):
+    """Benchmark records of all stages (or of `only` and the stages before them)"""
+    seed = params['seed']
+    sizes = dict(models=params['models'], scenarios=params['scenarios'], variables=params['variables'])
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        fnames = list(write_raw(tmp / 'raw', missing=params['missing'], seed=seed, **sizes).values())
+        meta = synthetic_meta(params['models'], params['scenarios'], seed)
+        mapping = synthetic_mapping(params['countries'], seed)
+        storage = synthetic_storage(mapping, seed)
+
+        todo = stages(fnames, meta, mapping, storage, tmp / 'ar6_cache')
+        if only:
+            last = max(list(todo).index(name) for name in only)
+            todo = dict(list(todo.items())[:last + 1])
+
+        results, records = {}, []
+        for name, func in todo.items():
+            result, seconds, peak = measure(func, results, repeat=repeat, memory=memory)
+            results[name] = result
+            records.append({
+                'stage': name,
+                'seconds': seconds,
+                'best': min(seconds),
+                'peak_mib': None if peak is None else peak / 2**20,
+                'rows': len(result) if hasattr(result, '__len__') else None,
+            })
+            print(f'[{name}] {min(seconds):.3f}s' + ('' if peak is None else f' {peak / 2**20:.1f} MiB'))
+    return records
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('stages', nargs='*', help='stages to run (with the stages they depend on), default all')
+    parser.add_argument('--models', type=int, default=10)
+    parser.add_argument('--scenarios', type=int, default=50, help='scenarios per model')
+    parser.add_argument('--variables', type=int, default=20, help='variables per scenario and region')
+    parser.add_argument('--countries', type=int, default=250)
+    parser.add_argument('--missing', type=float, default=0.1, help='share of missing values')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=3, help='timed runs per stage')
+    parser.add_argument('--no-memory', action='store_true', help='skip the traced run for peak memory')
+    parser.add_argument('--output', type=Path, default=here / '.benchmarks' / 'results.jsonl')
+    parser.add_argument('--compare', metavar='REV', help='compare with the latest results of a commit')
+    parser.add_argument('--raw', type=Path, metavar='DIR', help='only write synthetic raw files to DIR')
+    args = parser.parse_args()
+
+    params = {
+        name: getattr(args, name) for name in ['models', 'scenarios', 'variables', 'countries', 'missing', 'seed']
+    }
+    if args.raw:
+        for fname in write_raw(args.raw, **{k: v for k, v in params.items() if k != 'countries'}).values():
+            print(f'[wrote] {fname}')
+        return
+
+    unknown = set(args.stages) - set(stages([], None, None, None, None))
+    if unknown:
+        parser.error(f'unknown stages {sorted(unknown)}')
+
+    commit, dirty = git_commit()
+    records = run(params, repeat=args.repeat, memory=not args.no_memory, only=args.stages)
+    stamp = datetime.now(timezone.utc).isoformat(timespec='seconds')
+    context = {
+        'run': stamp,
+        'commit': commit,
+        'dirty': dirty,
+        'params': params,
+        'python': sys.version.split()[0],
+        'versions': library_versions(['numpy', 'pandas', 'pyarrow', 'scipy']),
+    }
+    args.output.parent.mkdir(parents=True, exist_ok=True)
+    with open(args.output, 'a') as f:
+        for record in records:
+            f.write(json.dumps({**context, **record}) + '\n')
+
+    if args.compare:
+        print(compare(read_results(args.output), resolve(args.compare), commit, params).round(3).to_string())
+
+
+if __name__ == '__main__':
+    main()
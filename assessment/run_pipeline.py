@@ -0,0 +1,348 @@
+"""Run the assessment notebooks in dependency order, skipping unchanged steps
+
+Each step is a notebook in its python form with the files it reads and
+writes. A step is re-run only if the content of its script, of `utils.py`
+(when it is imported) or of any of its inputs changed since its last
+successful run, or if one of its outputs is missing. Steps whose inputs are
+ready run in parallel.
+
+    $ python run_pipeline.py               # everything
+    $ python run_pipeline.py 202 --jobs 4  # 202 and whatever it depends on
+    $ python run_pipeline.py --profile     # time every cell, see utils.stage
+
+With `--profile` each notebook is run cell by cell and the wall time, CPU
+time, peak RSS and output shapes of every cell and of the instrumented
+functions in `utils.py` are logged to `data/derived/.profile.jsonl`. A
+summary of the slowest stages is printed at the end.
+"""
+
+import argparse
+import ast
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import time
+
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from pathlib import Path
+
+
+here = Path(__file__).resolve().parent
+root = here.parent
+packaged = root / 'data' / 'packaged'
+derived = root / 'data' / 'derived'
+raw = root / 'data' / 'raw'
+figures = root / 'figures'
+state_file = derived / '.pipeline_state.json'
+profile_file = derived / '.profile.jsonl'
+
+meta = raw / 'AR6_Scenarios_Database_metadata_indicators_v1.1.xlsx'
+storage = packaged / 'Analysis_dataset_20240602.csv'
+mapping = packaged / 'iso3c_region_mapping_20240602.csv'
+sensitivity = packaged / 'Sensitivity_table_20240602.xlsx'
+
+STEPS = {
+    '101_compile_storage_data': {
+        'inputs': [storage, mapping, sensitivity],
+        'outputs': [
+            derived / '101_Analysis_dataset_r5_r10.csv',
+            derived / '101_Analysis_dataset_all_regions.feather',
+            derived / '101_global_limits.csv',
+        ],
+    },
+    '102_compile_ccs_by_region': {
+        'inputs': [
+            raw / 'AR6_Scenarios_Database_World_v1.1.csv',
+            raw / 'AR6_Scenarios_Database_R5_regions_v1.1.csv',
+            raw / 'AR6_Scenarios_Database_R10_regions_v1.1.csv',
+            meta,
+        ],
+        'outputs': [
+            derived / '102_ccs_data_r5_r10.csv',
+            derived / '102_netzero_ccs_data_r5_r10.csv',
+            derived / '102_ccs_data_r5_r10.feather',
+            derived / '102_netzero_ccs_data_r5_r10.feather',
+        ],
+    },
+    '103_exceedence_years': {
+        'inputs': [
+            derived / '102_ccs_data_r5_r10.feather',
+            derived / '102_netzero_ccs_data_r5_r10.feather',
+            derived / '101_Analysis_dataset_r5_r10.csv',
+            sensitivity,
+        ],
+        'outputs': [derived / '103_exceedence_years.csv', derived / '103_exceedence_sensitivity.csv'],
+    },
+    '201_figure_diagram_3a': {
+        'inputs': [derived / '101_global_limits.csv', packaged / 'diagram_trajectories.xlsx'],
+        'outputs': [
+            figures / 'diagram_emissions.pdf',
+            figures / 'diagram_injection.pdf',
+            figures / 'diagram_storage.pdf',
+            figures / 'diagram_storage_legend.pdf',
+        ],
+    },
+    '202_figure_cum_storage_3bcd_and_si': {
+        'inputs': [
+            derived / '101_Analysis_dataset_r5_r10.csv',
+            derived / '102_ccs_data_r5_r10.feather',
+            derived / '102_netzero_ccs_data_r5_r10.feather',
+            derived / '103_exceedence_years.csv',
+            meta,
+        ],
+        'outputs': [
+            derived / '202_violin_kde.feather',
+            derived / '202_violin_quartiles.feather',
+            derived / '202_exceedance_box.feather',
+        ] + [
+            figures / f'figure_3{panel}.{ext}' for panel in 'bcd' for ext in ('pdf', 'png')
+        ] + [
+            figures / f'figure_si_like3_{region}.{ext}'
+            for region in ['R5ASIA', 'R5LAM', 'R5MAF', 'R5OECD90+EU', 'R5REF']
+            for ext in ('pdf', 'png')
+        ],
+    },
+    '203_figure_waterfall_2c': {
+        'inputs': [sensitivity],
+        'outputs': [figures / 'figure_2b.pdf'],
+    },
+    '204_figure_cbdrc_storage_4': {
+        'inputs': [
+            storage,
+            mapping,
+            packaged / 'carbon_major_iso_mapping.xlsx',
+            raw / 'Guetschow-et-al-2021-PRIMAP-hist_v2.3.1_20-Sep_2021.csv',
+            raw / 'emissions_low_granularity.csv',
+            raw / 'API_NY.GDP.PCAP.PP.KD_DS2_en_csv_v2_45514.csv',
+            raw / 'API_SP.POP.TOTL_DS2_en_csv_v2_34.csv',
+        ],
+        'outputs': [
+            derived / '204_primap_cumulative_co2.feather',
+            figures / 'figure_4a.pdf',
+            figures / 'figure_4b.pdf',
+        ],
+    },
+    '301_statements': {
+        'inputs': [
+            derived / '101_global_limits.csv',
+            derived / '102_ccs_data_r5_r10.feather',
+            derived / '102_netzero_ccs_data_r5_r10.feather',
+            meta,
+        ],
+        'outputs': [derived / '301_facts.json'],
+    },
+    '302_tables': {
+        'inputs': [mapping, storage],
+        'outputs': [derived / '302_table1.xlsx'],
+    },
+}
+
+
+def dependencies(steps=STEPS):
+    """Steps which write any of the inputs of each step"""
+    producers = {out: name for name, step in steps.items() for out in step['outputs']}
+    return {
+        name: sorted({producers[i] for i in step['inputs'] if i in producers})
+        for name, step in steps.items()
+    }
+
+
+def _hash_file(fname, h):
+    with open(fname, 'rb') as f:
+        for block in iter(lambda: f.read(2**20), b''):
+            h.update(block)
+
+
+def _definitions(source):
+    """Source segments and referenced names of the top-level names of a module
+
+    Statements which do not bind a name (docstring, module-level calls) are
+    returned separately as they apply to every name.
+    """
+    lines = source.splitlines(keepends=True)
+    defs, always = {}, []
+    for node in ast.parse(source).body:
+        start = min([node.lineno] + [d.lineno for d in getattr(node, 'decorator_list', [])])
+        segment = ''.join(lines[start - 1:node.end_lineno])
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            names = [node.name]
+        elif isinstance(node, (ast.Import, ast.ImportFrom)):
+            names = [(alias.asname or alias.name).split('.')[0] for alias in node.names]
+        elif isinstance(node, (ast.Assign, ast.AnnAssign, ast.AugAssign)):
+            targets = node.targets if isinstance(node, ast.Assign) else [node.target]
+            names = [n.id for t in targets for n in ast.walk(t) if isinstance(n, ast.Name)]
+        else:
+            always.append(segment)
+            continue
+        refs = {n.id for n in ast.walk(node) if isinstance(n, ast.Name)}
+        for name in names:
+            defs.setdefault(name, []).append((segment, refs))
+    return defs, always
+
+
+def imported_code(script, module):
+    """Source of what `script` imports from `module`, including everything it uses there
+
+    Returns None if `script` does not import from `module` and the whole
+    source if it imports the module itself or uses a star import.
+    """
+    names = set()
+    for node in ast.walk(ast.parse(script.read_text())):
+        if isinstance(node, ast.Import) and any(a.name == module.stem for a in node.names):
+            return module.read_text()
+        if isinstance(node, ast.ImportFrom) and node.module == module.stem:
+            if any(a.name == '*' for a in node.names):
+                return module.read_text()
+            names.update(a.name for a in node.names)
+    if not names:
+        return None
+
+    defs, always = _definitions(module.read_text())
+    used, todo = set(), list(names)
+    while todo:
+        name = todo.pop()
+        if name not in used and name in defs:
+            used.add(name)
+            todo.extend(ref for _, refs in defs[name] for ref in refs)
+    segments = always + [segment for name in sorted(used) for segment, _ in defs[name]]
+    return ''.join(dict.fromkeys(segments))
+
+
+def step_hash(name, steps=STEPS):
+    """Hash of the code and the content of all inputs of step `name`
+
+    Of `utils.py` only the definitions the step imports, and those they use,
+    are hashed, so that e.g. a change to a figure helper does not invalidate
+    the data steps.
+    """
+    script = here / f'{name}.py'
+    h = hashlib.sha256()
+    utils = imported_code(script, here / 'utils.py')
+    if utils is not None:
+        h.update(utils.encode())
+    for fname in [script] + steps[name]['inputs']:
+        h.update(str(fname.relative_to(root)).encode())
+        if fname.exists():
+            _hash_file(fname, h)
+    return h.hexdigest()
+
+
+def select(names, deps):
+    """`names` together with everything upstream of them"""
+    selected, todo = set(), list(names)
+    while todo:
+        name = todo.pop()
+        if name not in selected:
+            selected.add(name)
+            todo.extend(deps[name])
+    return selected
+
+
+def run_step(name, profile=None):
+    env = dict(os.environ, MPLBACKEND='Agg')
+    cmd = [sys.executable, f'{name}.py']
+    if profile is not None:
+        env['CSTORAGE_PROFILE'] = str(profile)
+        cmd = [sys.executable, '-c', f'from utils import run_cells; run_cells({name + ".py"!r})']
+    start = time.perf_counter()
+    proc = subprocess.run(cmd, cwd=here, env=env, capture_output=True, text=True)
+    return proc, time.perf_counter() - start
+
+
+def print_profile(profile, top=20):
+    import pandas as pd
+
+    from utils import profile_summary, read_profile
+
+    summary = profile_summary(read_profile(profile))
+    if summary.empty:
+        return
+    with pd.option_context('display.width', 200, 'display.max_colwidth', 60):
+        print(f'\nSlowest stages (all records in {profile.relative_to(root)})')
+        print(summary.head(top).round(2).to_string())
+
+
+def run(names=None, jobs=None, force=False, dry_run=False, profile=None, steps=STEPS):
+    deps = dependencies(steps)
+    todo = select(names or steps, deps)
+    state = json.loads(state_file.read_text()) if state_file.exists() else {}
+    figures.mkdir(exist_ok=True)
+    if profile is not None and not dry_run:
+        profile.unlink(missing_ok=True)
+
+    done, failed, running = set(), set(), {}
+    with ThreadPoolExecutor(jobs or os.cpu_count()) as pool:
+        while todo or running:
+            progressed = False
+            for name in sorted(todo):
+                pending = todo | set(running.values())
+                if any(d in failed for d in deps[name]):
+                    print(f'[skip] {name} (upstream failed)')
+                    failed.add(name)
+                    todo.discard(name)
+                    progressed = True
+                elif not any(d in pending for d in deps[name]):
+                    todo.discard(name)
+                    progressed = True
+                    key = step_hash(name, steps)
+                    outputs_exist = all(o.exists() for o in steps[name]['outputs'])
+                    if not force and state.get(name) == key and outputs_exist:
+                        print(f'[cached] {name}')
+                        done.add(name)
+                    elif dry_run:
+                        print(f'[would run] {name}')
+                        done.add(name)
+                    else:
+                        print(f'[run] {name}')
+                        running[pool.submit(run_step, name, profile)] = name
+            if not running:
+                if todo and not progressed:
+                    raise RuntimeError(f'Circular dependencies between {sorted(todo)}')
+                continue
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                proc, elapsed = future.result()
+                if proc.returncode == 0:
+                    # inputs of a step are stable once its upstream steps are done
+                    state[name] = step_hash(name, steps)
+                    state_file.write_text(json.dumps(state, indent=2))
+                    print(f'[done] {name} ({elapsed:.1f}s)')
+                    done.add(name)
+                else:
+                    print(f'[failed] {name} ({elapsed:.1f}s)\n{proc.stderr}')
+                    failed.add(name)
+    if profile is not None and not dry_run:
+        print_profile(profile)
+    return not failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('steps', nargs='*', help='step names or numeric prefixes, default all')
+    parser.add_argument('--jobs', '-j', type=int, default=None, help='number of steps run in parallel')
+    parser.add_argument('--force', action='store_true', help='run steps even if unchanged')
+    parser.add_argument('--dry-run', action='store_true', help='only report what would run')
+    parser.add_argument('--profile', action='store_true', help='record time and memory of every cell of the steps run')
+    args = parser.parse_args()
+
+    names = [
+        name for arg in args.steps for name in STEPS if name == arg or name.startswith(f'{arg}_')
+    ]
+    if args.steps and not names:
+        parser.error(f'unknown steps {args.steps}')
+    ok = run(
+        names,
+        jobs=args.jobs,
+        force=args.force,
+        dry_run=args.dry_run,
+        profile=profile_file if args.profile else None,
+    )
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,1554 @@
+"""Helpers shared by the assessment notebooks"""
+
+import contextlib
+import copy
+import functools
+import hashlib
+import importlib.metadata
+import inspect
+import json
+import multiprocessing
+import os
+import re
+import shutil
+import sys
+import time
+import types
+import warnings
+
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from pandas_indexing import ismatch
+import pyarrow as pa
+import pyarrow.csv as pcsv
+import pyarrow.dataset as ds
+import pyarrow.feather as feather
+import scipy.sparse as sp
+
+
+IAMC_LEVELS = ['Model', 'Scenario', 'Region', 'Variable', 'Unit']
+
+
+def file_hash(fname, blocksize=2**20):
+    h = hashlib.sha256()
+    with open(fname, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+
+# Instrumentation
+
+PROFILE_ENV = 'CSTORAGE_PROFILE'
+_profile = {'path': os.environ.get(PROFILE_ENV) or None, 'script': Path(sys.argv[0]).stem, 'stack': []}
+
+
+def enable_profiling(path, script=None):
+    """Append stage records to the json lines file `path`, or stop if None
+
+    Profiling is also enabled by naming the file in the environment variable
+    `CSTORAGE_PROFILE`. `script` labels the records, by default the name of
+    the running script.
+    """
+    _profile['path'] = None if path is None else str(path)
+    if script is not None:
+        _profile['script'] = script
+
+
+def _max_rss():
+    """Peak resident memory of the process so far in MiB"""
+    try:
+        import resource # not available on windows
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 2**20 if sys.platform == 'darwin' else rss / 2**10
+
+
+def _shapes(outputs):
+    """(rows, columns) of the frames and series among `outputs`, also inside lists and tuples"""
+    shapes = {}
+    for name, obj in outputs.items():
+        if isinstance(obj, (list, tuple)):
+            shapes.update(_shapes({f'{name}[{i}]': o for i, o in enumerate(obj)}))
+        elif isinstance(obj, pd.DataFrame):
+            shapes[name] = list(obj.shape)
+        elif isinstance(obj, pd.Series):
+            shapes[name] = [len(obj), 1]
+    return shapes
+
+
+@contextlib.contextmanager
+def stage(name):
+    """Record wall time, CPU time, peak RSS and output shapes of a pipeline stage
+
+    Does nothing unless profiling is enabled (see `enable_profiling`). Frames
+    and series put into the yielded dict are logged with their shapes; stages
+    can be nested.
+
+        >>> with stage('read snapshots') as outputs:
+        ...     outputs['data'] = data = read_vars(fname, vars)
+    """
+    if _profile['path'] is None:
+        yield {}
+        return
+
+    outputs = {}
+    parent = ' / '.join(_profile['stack'])
+    _profile['stack'].append(name)
+    started = time.strftime('%Y-%m-%dT%H:%M:%S')
+    start, times, rss = time.perf_counter(), os.times(), _max_rss()
+    error = True
+    try:
+        yield outputs
+        error = False
+    finally:
+        wall, end = time.perf_counter() - start, os.times()
+        _profile['stack'].pop()
+        max_rss = _max_rss()
+        record = {
+            'script': _profile['script'],
+            'stage': name,
+            'parent': parent,
+            'start': started,
+            'pid': os.getpid(),
+            'wall': wall,
+            'cpu': round(end.user + end.system - times.user - times.system, 6),
+            'cpu_children': round(
+                end.children_user + end.children_system - times.children_user - times.children_system, 6
+            ),
+            'max_rss_mib': max_rss,
+            'rss_growth_mib': None if rss is None else max_rss - rss,
+            'outputs': _shapes(outputs),
+            'error': error,
+        }
+        with open(_profile['path'], 'a') as f:
+            f.write(json.dumps(record) + '\n')
+
+
+def profiled(func):
+    """Record each call of `func` as a stage named after it, see `stage`"""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if _profile['path'] is None:
+            return func(*args, **kwargs)
+        with stage(func.__qualname__) as outputs:
+            outputs['result'] = result = func(*args, **kwargs)
+        return result
+    return wrapper
+
+
+def _changed(ns, before):
+    return {k: v for k, v in ns.items() if before.get(k) != id(v)}
+
+
+def run_cells(script):
+    """Run a notebook in its python form with each `# %%` cell recorded as a stage
+
+    Cells share one namespace as when running the script itself. Frames and
+    series bound or rebound in a cell are logged as its outputs.
+    """
+    script = Path(script)
+    source = script.read_text()
+    starts = sorted({0} | {m.start() for m in re.finditer(r'^# %%', source, flags=re.M)})
+    ends = starts[1:] + [len(source)]
+    # cells run in a fresh __main__ module, so that their functions can be pickled for process pools
+    module = types.ModuleType('__main__')
+    module.__file__ = str(script)
+    sys.modules['__main__'] = module
+    ns = module.__dict__
+    sys.argv = [str(script)]
+    _profile['script'] = script.stem
+    for i, (a, b) in enumerate(zip(starts, ends)):
+        line = source.count('\n', 0, a) + 1
+        # pad with empty lines so that tracebacks point to the lines of the script
+        code = compile('\n' * (line - 1) + source[a:b], str(script), 'exec')
+        before = {k: id(v) for k, v in ns.items()}
+        with stage(f'cell {i} (line {line})') as outputs:
+            exec(code, ns)
+            outputs.update(_changed(ns, before))
+
+
+def register_cell_hooks(shell=None):
+    """Record each cell run in an IPython `shell` (the current one by default) as a stage
+
+    Called on import of this module in IPython if `CSTORAGE_PROFILE` is set.
+    """
+    if shell is None:
+        from IPython import get_ipython
+
+        shell = get_ipython()
+    if shell is None:
+        return
+    current = {}
+
+    def pre_run_cell(info):
+        current['before'] = {k: id(v) for k, v in shell.user_ns.items()}
+        current['stage'] = stage(f'cell {shell.execution_count}')
+        current['outputs'] = current['stage'].__enter__()
+
+    def post_run_cell(result):
+        if 'stage' not in current:
+            return
+        current['outputs'].update(_changed(shell.user_ns, current['before']))
+        current.pop('stage').__exit__(None, None, None)
+
+    shell.events.register('pre_run_cell', pre_run_cell)
+    shell.events.register('post_run_cell', post_run_cell)
+
+
+def read_profile(path):
+    """Stage records of the json lines file `path` as a frame"""
+    path = Path(path)
+    if not path.exists():
+        return pd.DataFrame()
+    return pd.DataFrame([json.loads(line) for line in path.read_text().splitlines() if line.strip()])
+
+
+def profile_summary(records):
+    """Calls, total wall and CPU time and peak RSS per script and stage, slowest first"""
+    if records.empty:
+        return records
+    return (
+        records.assign(stage=lambda df: df['parent'].where(df['parent'] == '', df['parent'] + ' / ') + df['stage'])
+        .groupby(['script', 'stage'])
+        .agg(
+            calls=('wall', 'size'),
+            wall=('wall', 'sum'),
+            cpu=('cpu', 'sum'),
+            cpu_children=('cpu_children', 'sum'),
+            max_rss_mib=('max_rss_mib', 'max'),
+        )
+        .sort_values('wall', ascending=False)
+    )
+
+# Derived artifacts
+
+def _code_hash(func):
+    try:
+        code = inspect.getsource(func)
+    except (OSError, TypeError):
+        code = func.__code__.co_code.hex() + repr(func.__code__.co_consts)
+    return hashlib.sha256(code.encode()).hexdigest()
+
+
+def _entry_file(cache, key):
+    # one record per artifact, so notebooks sharing a cache never overwrite each other's entries
+    return Path(cache) / f'{key}.entry.json'
+
+
+def _read_entry(cache, key):
+    fname = _entry_file(cache, key)
+    try:
+        return json.loads(fname.read_text())
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+def _write_entry(cache, key, entry):
+    fname = _entry_file(cache, key)
+    tmp = fname.with_name(f'.{fname.name}.{os.getpid()}')
+    tmp.write_text(json.dumps(entry, indent=2))
+    os.replace(tmp, fname)
+
+
+def _read_manifest(cache):
+    """Records of all artifacts in `cache` by key"""
+    entries = {}
+    for fname in Path(cache).glob('*.entry.json'):
+        key = fname.name[:-len('.entry.json')]
+        entry = _read_entry(cache, key)
+        if entry is not None:
+            entries[key] = entry
+    return entries
+
+
+def _replace(src, dst):
+    # copy next to `dst` and rename, so notebooks running in parallel never see partial files
+    tmp = Path(dst).with_name(f'.{Path(dst).name}.{os.getpid()}')
+    shutil.copyfile(src, tmp)
+    os.replace(tmp, dst)
+
+
+def evict(cache, max_size=None, max_age=None):
+    """Drop cached artifacts last used more than `max_age` seconds ago and the
+    least recently used ones beyond a total of `max_size` bytes"""
+    entries = _read_manifest(cache)
+    now, total = time.time(), 0
+    for key, entry in sorted(entries.items(), key=lambda kv: kv[1]['accessed'], reverse=True):
+        total += entry['size']
+        too_old = max_age is not None and now - entry['accessed'] > max_age
+        too_big = max_size is not None and total > max_size
+        if too_old or too_big:
+            _entry_file(cache, key).unlink(missing_ok=True)
+            (Path(cache) / entry['file']).unlink(missing_ok=True)
+            total -= entry['size']
+
+
+def _artifact_key(path, code, inputs=(), params=None):
+    params = json.loads(json.dumps(params or {}, sort_keys=True, default=str))
+    hashes = {str(f): file_hash(f) for f in inputs}
+    key = hashlib.sha256(json.dumps([path.name, code, hashes, params]).encode()).hexdigest()
+    entry = {'name': path.name, 'file': f'{key}{path.suffix}', 'code': code, 'inputs': hashes, 'params': params}
+    return key, entry
+
+
+def _restore(path, cache, key):
+    """Copy the cached artifact `key` to `path`, returns whether there is one"""
+    entry = _read_entry(cache, key)
+    if entry is None or not (cache / entry['file']).exists():
+        return False
+    shutil.copyfile(cache / entry['file'], path)
+    _write_entry(cache, key, dict(entry, accessed=time.time()))
+    return True
+
+
+def _store(path, cache, key, entry):
+    _replace(path, cache / entry['file'])
+    now = time.time()
+    _write_entry(cache, key, dict(entry, created=now, size=path.stat().st_size, accessed=now))
+
+
+def cached_artifact(path, write, inputs=(), params=None, code=None, cache=None, max_size=None, max_age=None):
+    """Create the artifact `path` by calling `write(path)` unless it is cached
+
+    The cache key hashes the source of `write` (or `code`), the content of all
+    `inputs` and `params`. Artifacts are stored under their key in `cache`
+    (by default `.cache` next to `path`), each with a record of its inputs
+    and params, so several parameterisations of an artifact are kept side
+    by side. On a hit, the cached file is copied to `path` without calling
+    `write`. Returns whether it was a hit.
+    """
+    path = Path(path)
+    cache = Path(cache or path.parent / '.cache')
+    cache.mkdir(parents=True, exist_ok=True)
+
+    code = hashlib.sha256(code.encode()).hexdigest() if code is not None else _code_hash(write)
+    key, entry = _artifact_key(path, code, inputs, params)
+    hit = _restore(path, cache, key)
+    if not hit:
+        write(path)
+        _store(path, cache, key, entry)
+
+    if max_size is not None or max_age is not None:
+        evict(cache, max_size=max_size, max_age=max_age)
+    return hit
+
+
+def _year_columns(columns):
+    return [int(c) if isinstance(c, str) and c.lstrip('-').isdigit() else c for c in columns]
+
+
+@profiled
+def write_derived(df, path):
+    """Write `df` to an uncompressed feather file with categorical index levels
+
+    Year columns are restored as integers by `read_derived`, an unnamed index
+    is not stored.
+    """
+    index = [name for name in df.index.names if name is not None]
+    data = df.reset_index() if index else df.reset_index(drop=True)
+    for level in index:
+        data[level] = data[level].astype('category')
+    data.columns = data.columns.map(str)
+    table = pa.Table.from_pandas(data, preserve_index=False)
+    metadata = dict(table.schema.metadata, index=json.dumps(index))
+    feather.write_feather(table.replace_schema_metadata(metadata), path, compression='uncompressed')
+
+
+@profiled
+def read_derived(path, nlevels=5):
+    """Read a frame written by `write_derived`
+
+    The file is memory-mapped while reading, but the frame is a copy in memory
+    (missing values and the index are not kept as arrow buffers). Falls back
+    to the csv file of the same name with `nlevels` index columns if there is
+    no feather file.
+    """
+    path = Path(path)
+    if not path.exists() and path.with_suffix('.csv').exists():
+        df = pd.read_csv(path.with_suffix('.csv'), index_col=list(range(nlevels)))
+        df.columns = _year_columns(df.columns)
+        return df
+
+    table = feather.read_table(path, memory_map=True)
+    index = json.loads(table.schema.metadata[b'index'])
+    df = table.to_pandas(split_blocks=True)
+    if index:
+        df = df.set_index(index)
+    df.columns = _year_columns(df.columns)
+    return df
+
+
+@profiled
+def read_excel_cached(fname, cache=None, categorical=(), **kwargs):
+    """`pd.read_excel(fname, **kwargs)`, parsed once and then read from a feather copy
+
+    The copies are kept in `cache` (by default `.cache` next to `fname`),
+    keyed on the content of the file and the read options, and read directly
+    from there, so notebooks running in parallel can share them. `categorical`
+    columns (e.g. `Category`) are stored as categoricals.
+    """
+    fname = Path(fname)
+    cache = Path(cache or fname.parent / '.cache')
+    cache.mkdir(parents=True, exist_ok=True)
+
+    params = dict(kwargs, categorical=list(categorical))
+    key, entry = _artifact_key(cache / f'{fname.stem}.feather', _code_hash(read_excel_cached), [fname], params)
+    if not (cache / entry['file']).exists():
+        df = pd.read_excel(fname, **kwargs)
+        df = df.astype({c: 'category' for c in categorical if c in df.columns})
+        tmp = cache / f'.{key}.{os.getpid()}'
+        write_derived(df, tmp)
+        _store(tmp, cache, key, entry)
+        tmp.unlink()
+    return read_derived(cache / entry['file'])
+
+
+# AR6 snapshot files
+
+def ar6_scope(fname):
+    """Region scope of an AR6 snapshot file, e.g. 'World', 'R5' or 'R10'"""
+    stem = Path(fname).stem
+    m = re.match(r'AR6_Scenarios_Database_(\w+?)(?:_regions)?_v[\d.]+$', stem)
+    return m.group(1) if m else stem
+
+
+def _cache_is_valid(fname, manifest):
+    if not manifest.is_file():
+        return False
+    info = json.loads(manifest.read_text())
+    stat = os.stat(fname)
+    if (info['size'], info['mtime']) == (stat.st_size, stat.st_mtime):
+        return True
+    # file was touched, only rebuild if the content changed
+    if info['sha256'] != file_hash(fname):
+        return False
+    info.update(size=stat.st_size, mtime=stat.st_mtime)
+    manifest.write_text(json.dumps(info, indent=2))
+    return True
+
+
+@profiled
+def build_ar6_cache(fname, cache_path, force=False):
+    """Convert an AR6 snapshot csv to a parquet dataset partitioned by Variable
+
+    The dataset is written to `cache_path / 'scope=<scope>'` and only rebuilt
+    when the content of `fname` changes.
+    """
+    path = Path(cache_path) / f'scope={ar6_scope(fname)}'
+    manifest = path / '_source.json'
+    if not force and _cache_is_valid(fname, manifest):
+        return path
+
+    if path.exists():
+        shutil.rmtree(path)
+    header = pd.read_csv(fname, nrows=0).columns
+    types = {c: pa.string() if c in IAMC_LEVELS else pa.float64() for c in header}
+    reader = pcsv.open_csv(
+        fname,
+        read_options=pcsv.ReadOptions(block_size=2**26),
+        convert_options=pcsv.ConvertOptions(column_types=types),
+    )
+    ds.write_dataset(
+        reader,
+        path,
+        format='parquet',
+        partitioning=ds.partitioning(pa.schema([('Variable', pa.string())]), flavor='hive'),
+        max_partitions=100_000,
+    )
+
+    stat = os.stat(fname)
+    info = {
+        'source': str(fname),
+        'sha256': file_hash(fname),
+        'size': stat.st_size,
+        'mtime': stat.st_mtime,
+        'columns': list(header),
+    }
+    manifest.write_text(json.dumps(info, indent=2))
+    return path
+
+
+def _read_ar6_cache(path, vars, regions=None, years=None):
+    columns = json.loads((path / '_source.json').read_text())['columns']
+    if years is not None:
+        wanted = {str(y) for y in years}
+        columns = [c for c in columns if c in IAMC_LEVELS or c in wanted]
+
+    dataset = ds.dataset(
+        path,
+        format='parquet',
+        partitioning=ds.partitioning(pa.schema([('Variable', pa.string())]), flavor='hive'),
+    )
+    expr = ds.field('Variable').isin(list(vars))
+    if regions is not None:
+        expr &= ds.field('Region').isin(list(regions))
+    return dataset.to_table(columns=columns, filter=expr).to_pandas()
+
+
+@profiled
+def read_vars(fname, vars=[], regions=None, years=None, chunksize=100_000, cache=None):
+    """Read `vars` from an AR6 snapshot csv, optionally only for `regions` and `years`
+
+    The file is parsed in chunks which are filtered while reading, so rows
+    which are not requested are never held in memory.
+
+    If `cache` is a directory, the file is converted once to a parquet dataset
+    there (see `build_ar6_cache`) and read through predicate pushdown instead.
+    """
+    if cache is not None:
+        return _read_ar6_cache(build_ar6_cache(fname, cache), vars, regions, years)
+
+    header = pd.read_csv(fname, nrows=0).columns
+    ycols = [c for c in header if c not in IAMC_LEVELS]
+    if years is not None:
+        wanted = {str(y) for y in years}
+        ycols = [c for c in ycols if c in wanted]
+    usecols = [c for c in header if c in IAMC_LEVELS or c in ycols]
+
+    reader = pd.read_csv(
+        fname,
+        usecols=usecols,
+        dtype={c: float for c in ycols},
+        chunksize=chunksize,
+    )
+    chunks = []
+    for chunk in reader:
+        keep = chunk.Variable.isin(vars)
+        if regions is not None:
+            keep &= chunk.Region.isin(regions)
+        chunks.append(chunk[keep])
+    if not chunks:
+        return pd.DataFrame(columns=usecols)
+    return pd.concat(chunks)
+
+
+@profiled
+def read_csv_filtered(fname, filters, usecols=None, chunksize=100_000, **kwargs):
+    """Read the rows of a csv file whose `filters` columns hold the given values
+
+    `filters` maps column names to a value or a list of values. The file is
+    parsed in chunks which are filtered while reading and only the filter
+    columns and `usecols` are parsed; the result has the `usecols` columns
+    (all if None). `kwargs` are passed to `pd.read_csv`.
+    """
+    filters = {col: [v] if isinstance(v, str) else list(v) for col, v in filters.items()}
+    columns = None if usecols is None else list(dict.fromkeys([*filters, *usecols]))
+    chunks = []
+    for chunk in pd.read_csv(fname, usecols=columns, chunksize=chunksize, **kwargs):
+        keep = np.ones(len(chunk), dtype=bool)
+        for col, values in filters.items():
+            keep &= chunk[col].isin(values).to_numpy()
+        chunks.append(chunk.loc[keep, list(usecols) if usecols is not None else chunk.columns])
+    if not chunks:
+        return pd.DataFrame(columns=usecols)
+    return pd.concat(chunks)
+
+
+def _limit_memory(max_memory):
+    import resource # not available on windows
+
+    resource.setrlimit(resource.RLIMIT_AS, (max_memory, max_memory))
+
+
+@profiled
+def read_all_vars(fnames, max_workers=None, max_memory=None, **kwargs):
+    """Run `read_vars` for each of `fnames` in a process pool
+
+    Frames are returned in the order of `fnames`. `max_memory` caps the address
+    space (in bytes) of each worker, so that a worker which runs out of memory
+    fails with a `MemoryError` rather than taking down the node.
+    """
+    max_workers = max_workers or min(len(fnames), os.cpu_count())
+    with ProcessPoolExecutor(
+        max_workers,
+        initializer=_limit_memory if max_memory else None,
+        initargs=(max_memory,) if max_memory else (),
+    ) as pool:
+        return list(pool.map(partial(read_vars, **kwargs), fnames))
+
+
+# Region aggregation
+
+class RegionMatrix:
+    """Sparse region x country membership for all region definitions of a mapping
+
+    Every column of `mapping` apart from the country `key` and the `exclude`d
+    descriptive columns is a region definition (scheme), e.g. `r5_iamc` or
+    `r22_ipcc`. A `world` scheme with a single region containing all countries
+    is added unless `world=None`.
+    """
+
+    def __init__(self, mapping, key='iso3c', exclude=('m49code', 'alpha-3', 'name'), world='World'):
+        mapping = mapping.drop_duplicates(subset=key).set_index(key)
+        schemes = [c for c in mapping.columns if c not in exclude]
+        self.countries = mapping.index
+
+        codes, regions = [], []
+        for scheme in schemes:
+            scheme_codes, labels = pd.factorize(mapping[scheme], sort=True)
+            codes.append(np.where(scheme_codes < 0, -1, scheme_codes + len(regions)))
+            regions.extend((scheme, label) for label in labels)
+        if world is not None:
+            codes.append(np.full(len(self.countries), len(regions)))
+            regions.append((world, world))
+        self.regions = pd.MultiIndex.from_tuples(regions, names=['scheme', 'Region'])
+
+        codes = np.concatenate(codes)
+        cols = np.tile(np.arange(len(self.countries)), len(codes) // len(self.countries))
+        assigned = codes >= 0
+        self.matrix = sp.csr_matrix(
+            (np.ones(assigned.sum()), (codes[assigned], cols[assigned])),
+            shape=(len(self.regions), len(self.countries)),
+        )
+
+    @property
+    def schemes(self):
+        return self.regions.unique('scheme')
+
+    @profiled
+    def aggregate(self, df, schemes=None, level=None):
+        """Sums of the rows of `df` per region of `schemes` in a single sparse product
+
+        `df` is indexed by country (or has a country `level`), rows of
+        countries missing from the mapping are ignored and NaN counts as 0. The
+        result is indexed by (scheme, Region) in the order of `schemes`.
+        """
+        rows = np.arange(len(self.regions))
+        if schemes is not None:
+            schemes = [schemes] if isinstance(schemes, str) else list(schemes)
+            rows = np.concatenate([np.flatnonzero(self.regions.get_level_values('scheme') == s) for s in schemes])
+        countries = df.index if level is None else df.index.get_level_values(level)
+        idx = self.countries.get_indexer(countries)
+        found = idx >= 0
+        # columns of the matrix picked per row of df, so duplicate country rows are all counted
+        select = self.matrix[rows][:, idx[found]]
+        values = np.nan_to_num(df.to_numpy(dtype=float)[found])
+        return pd.DataFrame(select @ values, index=self.regions[rows], columns=df.columns)
+
+
+# Emissions attribution
+
+@profiled
+def attribute_emissions(
+    emissions, mapping, entity='parent_entity', by='year', value='total_emissions_MtCO2e', key='name', target='iso3c'
+):
+    """Sum the `value` of each `entity` of `emissions` per country it is
+    assigned to in `mapping` (columns `key` and `target`) and per `by`
+
+    Entities and `by` are integer coded and summed with one bincount, so any
+    further columns (e.g. commodities in the higher granularity carbon majors
+    files) are summed over. The entity sums are assigned to countries with a
+    sparse country x entity matrix. As an inner merge followed by a grouped
+    sum, entities missing in `mapping` are ignored, missing values count as 0
+    and combinations without any rows are NaN.
+    """
+    mapping = mapping.dropna(subset=[key, target])
+    entities = pd.Index(mapping[key].unique())
+    codes = entities.get_indexer(emissions[entity])
+    found = codes >= 0
+    periods, labels = pd.factorize(emissions[by].to_numpy()[found], sort=True)
+    flat = codes[found] * len(labels) + periods
+    shape = len(entities), len(labels)
+    weights = np.nan_to_num(emissions[value].to_numpy(dtype=float)[found])
+    totals = np.bincount(flat, weights=weights, minlength=np.prod(shape)).reshape(shape)
+    counts = np.bincount(flat, minlength=np.prod(shape)).reshape(shape)
+
+    countries, names = pd.factorize(mapping[target], sort=True)
+    members = sp.csr_matrix(
+        (np.ones(len(mapping)), (countries, entities.get_indexer(mapping[key]))),
+        shape=(len(names), len(entities)),
+    )
+    reported = (members @ counts) > 0
+    df = pd.DataFrame(
+        np.where(reported, members @ totals, np.nan),
+        index=pd.Index(names, name=target),
+        columns=pd.Index(labels, name=by),
+    )
+    return df[reported.any(axis=1)]
+
+
+# Timeseries operations
+
+def values_at_years(ts, years, interpolate=False):
+    """Values of the wide timeseries `ts` in a year per (model, scenario)
+
+    `years` is indexed by the first two levels of `ts`. Rows with a NaN year or
+    a year outside the columns of `ts` are NaN. Fractional years are linearly
+    interpolated if `interpolate` is set and NaN otherwise.
+    """
+    cols = np.asarray(ts.columns, dtype=float)
+    values = ts.to_numpy(dtype=float)
+    idx = pd.MultiIndex.from_arrays([ts.index.get_level_values(i) for i in range(2)])
+    y = years.reindex(idx).to_numpy(dtype=float)
+    rows = np.arange(len(values))
+
+    lo = np.clip(np.searchsorted(cols, y, side='right') - 1, 0, len(cols) - 1)
+    exact = cols[lo] == y
+    ret = np.where(exact, values[rows, lo], np.nan)
+    if interpolate:
+        hi = np.minimum(lo + 1, len(cols) - 1)
+        inside = ~exact & (cols[lo] < y) & (y < cols[hi])
+        w = (y - cols[lo]) / (cols[hi] - cols[lo])
+        between = (1 - w) * values[rows, lo] + w * values[rows, hi]
+        ret = np.where(inside, between, ret)
+    return pd.Series(ret, index=ts.index)
+
+
+@profiled
+def value_at_net_zero(ts, meta, indicators, interpolate=False):
+    """Values of the wide timeseries `ts` in the net-zero years of `meta` `indicators`
+
+    `indicators` maps meta columns to the placeholder year the values are
+    reported under, e.g. `{'Year of netzero CO2 emissions ...': -1}`.
+    """
+    return pd.concat([
+        values_at_years(ts, meta[name], interpolate=interpolate).pix.assign(year=year)
+        for name, year in indicators.items()
+    ])
+
+
+def _tail_slope(values, years, tail):
+    """Least-squares slope and last point of the last `tail` finite values per row"""
+    finite = np.isfinite(values)
+    rank = np.cumsum(finite[:, ::-1], axis=1)[:, ::-1]
+    w = finite & (rank <= tail)
+    n = w.sum(axis=1)
+    x = np.where(w, years, 0.)
+    y = np.where(w, values, 0.)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        xm = x.sum(axis=1) / n
+        ym = y.sum(axis=1) / n
+        dx = np.where(w, years - xm[:, None], 0.)
+        slope = (dx * (y - ym[:, None])).sum(axis=1) / (dx ** 2).sum(axis=1)
+    last = np.where(finite.any(axis=1), finite.shape[1] - 1 - np.argmax(finite[:, ::-1], axis=1), 0)
+    rows = np.arange(len(values))
+    return slope, years[last], values[rows, last]
+
+
+def exceedance_years(values, years, limits, horizon=2300, tail=2, precise=False, max_cells=2**26):
+    """First year in which each row of `values` exceeds each of `limits`
+
+    `values` is an (n, t) array over `years` and `limits` either an (l,) or an
+    (n, l) array. Beyond the last finite value, rows are extrapolated linearly
+    with the slope fitted through their last `tail` finite values.
+
+    Returns an (n, l) array of the first (integer) year with a value above the
+    limit, or of the interpolated crossing point if `precise` is set. Rows
+    which do not exceed a limit up to `horizon` are `np.inf`.
+    """
+    values = np.asarray(values, dtype=float)
+    years = np.asarray(years, dtype=float)
+    n, t = values.shape
+    limits = np.asarray(limits, dtype=float)
+    limits = np.broadcast_to(limits if limits.ndim == 2 else limits[None, :], (n, limits.shape[-1]))
+
+    # index of the first column above the limit, using the running maximum
+    # which is monotonic, processing limits in blocks to cap memory
+    runmax = np.maximum.accumulate(np.where(np.isnan(values), -np.inf, values), axis=1)
+    block = max(1, max_cells // max(n * t, 1))
+    k = np.concatenate([
+        (runmax[:, :, None] <= limits[:, None, i:i + block]).sum(axis=1)
+        for i in range(0, limits.shape[1], block)
+    ], axis=1) if limits.shape[1] else np.empty((n, 0), dtype=int)
+
+    rows = np.arange(n)[:, None]
+    kc = np.minimum(k, t - 1)
+    ret = years[kc]
+    if precise:
+        prev = np.maximum(kc - 1, 0)
+        v0, v1 = values[rows, prev], values[rows, kc]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            step = years[prev] + (limits - v0) / (v1 - v0) * (years[kc] - years[prev])
+        ret = np.where((kc > 0) & np.isfinite(step), step, ret)
+
+    # extrapolate the rest
+    slope, ylast, vlast = _tail_slope(values, years, tail)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        cross = ylast[:, None] + (limits - vlast[:, None]) / slope[:, None]
+    if not precise:
+        cross = np.floor(cross) + 1
+    cross = np.where((slope[:, None] > 0) & (cross <= horizon), cross, np.inf)
+    return np.where(k < t, ret, cross)
+
+
+def _region_limits(index, limits):
+    """Limit values and notes of `limits` for the Region of each row of `index`"""
+    regions = limits.index.get_level_values(0).unique()
+    thresholds = limits.index.get_level_values(1).unique()
+    values = limits['value'].unstack().reindex(index=regions, columns=thresholds)
+    notes = limits['note'].unstack().reindex(index=regions, columns=thresholds)
+    codes = regions.get_indexer(index.get_level_values('Region'))
+    return codes, values.to_numpy(dtype=float), notes.to_numpy()
+
+
+def _stack_by_region(index, values, codes, notes, label):
+    """Long series of (n, l) `values`, ordered by region, threshold and row"""
+    n, l = values.shape
+    row, j = (a.ravel() for a in np.meshgrid(np.arange(n), np.arange(l), indexing='ij'))
+    keep = codes[row] >= 0
+    row, j = row[keep], j[keep]
+    keep = pd.notna(notes[codes[row], j])
+    row, j = row[keep], j[keep]
+    order = np.lexsort((row, j, codes[row]))
+    row, j = row[order], j[order]
+    return pd.Series(values[row, j], index=index[row]).pix.assign(**{label: notes[codes[row], j]})
+
+
+@profiled
+def exceedance_table(
+    cdf,
+    zdf,
+    limits,
+    variable='Cumulative Carbon Sequestration|CCS',
+    rate='Carbon Sequestration|CCS',
+    label='Threshold',
+    **kwargs,
+):
+    """Years to exceed `limits` at net-zero CO2 levels and the year of exceedance
+
+    `limits` is indexed by (Region, threshold) with columns 'value', in the
+    units of `variable`, and 'note', which is used as the `label` level of the
+    result. Each row of the wide cumulative frame `cdf` and the net-zero frame
+    `zdf` is compared to all thresholds of its region at once; `kwargs` are
+    passed to `exceedance_years`.
+
+    The exceedance year is NaN where a limit is not exceeded by the horizon,
+    which is flagged explicitly by 'Exceeds by horizon' being False; it is
+    missing only for rows without any data.
+    """
+    nz = zdf['Net Zero CO2']
+    nz_value = nz.loc[ismatch(Variable=variable)].droplevel('Variable')
+    nz_rate = nz.loc[ismatch(Variable=rate)].droplevel('Variable')
+    nz_value, nz_rate = nz_value.align(nz_rate)
+    codes, lvalues, notes = _region_limits(nz_value.index, limits)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        ttl = (lvalues[codes] - nz_value.to_numpy()[:, None]) / nz_rate.to_numpy()[:, None]
+    nzdf = _stack_by_region(nz_value.index, ttl, codes, notes, label)
+
+    ydf = cdf.loc[ismatch(Variable=variable)]
+    codes, lvalues, notes = _region_limits(ydf.index, limits)
+    years = exceedance_years(ydf.to_numpy(), ydf.columns.astype(int), lvalues[codes], **kwargs)
+    exdf = _stack_by_region(ydf.index, np.where(np.isinf(years), np.nan, years), codes, notes, label)
+    has_data = np.isfinite(ydf.to_numpy(dtype=float)).any(axis=1)
+    exceeds = np.where(np.isfinite(years), 1., np.where(has_data[:, None], 0., np.nan))
+    exceeds = _stack_by_region(ydf.index, exceeds, codes, notes, label).astype('boolean')
+
+    return (
+        nzdf.droplevel('Unit').to_frame('Years to Exceed at Net-zero CO2 Levels')
+        .join(exdf.droplevel(['Variable', 'Unit']).to_frame('Exceedance Year'))
+        .join(exceeds.droplevel(['Variable', 'Unit']).to_frame('Exceeds by horizon'))
+    )
+
+
+def _nanquantile_inf(arr, quantiles):
+    """`np.nanquantile` along axis 0 giving +/-inf rather than NaN where infinite values are involved"""
+    big = np.finfo(float).max / 4
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning) # all-NaN columns
+        finite = np.where(np.isfinite(arr), arr, np.nan)
+        lo, hi = np.nanmin(finite, axis=0), np.nanmax(finite, axis=0)
+        q = np.nanquantile(np.clip(arr, -big, big), quantiles, axis=0)
+    # anything interpolated beyond the finite range involves an infinite value
+    q[(q > hi) | (q >= big)] = np.inf
+    q[(q < lo) | (q <= -big)] = -np.inf
+    return q
+
+
+def exceedance_sweep(
+    cdf,
+    zdf,
+    samples,
+    groups=None,
+    quantiles=(0.05, 0.25, 0.5, 0.75, 0.95),
+    chunksize=100,
+    variable='Cumulative Carbon Sequestration|CCS',
+    rate='Carbon Sequestration|CCS',
+    **kwargs,
+):
+    """Quantiles over scenarios of time to limit and exceedance year for many limits
+
+    `samples` holds one row per sample of storage limits and one column per
+    Region, in the units of `variable`. Samples are evaluated `chunksize` at a
+    time and a frame of quantiles indexed by (sample, Region, group, quantile)
+    is yielded per chunk, so only scenarios x `chunksize` values are ever held
+    in memory. `groups` optionally maps (Model, Scenario) to a group, e.g. the
+    Category. Scenarios which never exceed a limit have an inf exceedance year.
+    """
+    nz = zdf['Net Zero CO2']
+    nz_value = nz.loc[ismatch(Variable=variable)].droplevel(['Variable', 'Unit'])
+    nz_rate = nz.loc[ismatch(Variable=rate)].droplevel(['Variable', 'Unit'])
+    nz_value, nz_rate = nz_value.align(nz_rate)
+    ydf = cdf.loc[ismatch(Variable=variable)].droplevel(['Variable', 'Unit'])
+    years = ydf.columns.astype(int)
+
+    uniques = pd.Index(['all'] if groups is None else np.sort(groups.dropna().unique()))
+
+    def group_codes(index):
+        if groups is None:
+            return np.zeros(len(index), dtype=int)
+        return uniques.get_indexer(groups.reindex(index.droplevel('Region')))
+
+    def summarise(arr, codes):
+        q = np.full((len(uniques), len(quantiles), arr.shape[1]), np.nan)
+        share = np.full((len(uniques), arr.shape[1]), np.nan)
+        for i in range(len(uniques)):
+            _arr = arr[codes == i]
+            if len(_arr):
+                q[i] = _nanquantile_inf(_arr, quantiles)
+                share[i] = np.isfinite(_arr).mean(axis=0)
+        return q, share
+
+    by_region = {}
+    for region in samples.columns:
+        value = nz_value.loc[ismatch(Region=region)]
+        cum = ydf.loc[ismatch(Region=region)]
+        by_region[region] = (
+            value.to_numpy(),
+            nz_rate.loc[ismatch(Region=region)].to_numpy(),
+            group_codes(value.index),
+            cum.to_numpy(),
+            group_codes(cum.index),
+        )
+
+    for start in range(0, len(samples), chunksize):
+        chunk = samples.iloc[start:start + chunksize]
+        n = len(chunk)
+        frames = []
+        for region, (value, nzrate, vcodes, cum, ccodes) in by_region.items():
+            limits = chunk[region].to_numpy(dtype=float)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                ttl = (limits[None, :] - value[:, None]) / nzrate[:, None]
+            ttl, _ = summarise(ttl, vcodes)
+            exceed, share = summarise(exceedance_years(cum, years, limits, **kwargs), ccodes)
+            for i, group in enumerate(uniques):
+                frames.append(pd.DataFrame({
+                    'sample': np.tile(chunk.index, len(quantiles)),
+                    'Region': region,
+                    'group': group,
+                    'quantile': np.repeat(quantiles, n),
+                    'Years to Exceed at Net-zero CO2 Levels': ttl[i].ravel(),
+                    'Exceedance Year': exceed[i].ravel(),
+                    'Share Exceeding': np.tile(share[i], len(quantiles)),
+                }))
+        yield pd.concat(frames).set_index(['sample', 'Region', 'group', 'quantile']).sort_index()
+
+
+def cumulate(ts, start=2010, end=2100, method='step', offset=False):
+    """Cumulative integral over the years `start` to `end` of the wide timeseries `ts`
+
+    With `method='step'` each value counts for the years since the previous
+    one (a plain cumulative sum on an annual grid), with `'trapezoid'` the
+    integral is zero in `start` and grows by the trapezoidal area of each
+    step. If `offset` is set, the value in `start` is subtracted first.
+    Missing values stay missing in the result.
+    """
+    ts = ts.loc[:, (ts.columns >= start) & (ts.columns <= end)]
+    years = np.asarray(ts.columns, dtype=float)
+    values = ts.to_numpy(dtype=float)
+    if offset:
+        values = values - values[:, [0]]
+    nan = np.isnan(values)
+    values = np.where(nan, 0., values)
+
+    if method == 'step':
+        ret = np.cumsum(values * np.diff(years, prepend=years[0] - 1), axis=1)
+    elif method == 'trapezoid':
+        steps = (values[:, 1:] + values[:, :-1]) / 2 * np.diff(years)
+        ret = np.concatenate([np.zeros((len(values), 1)), np.cumsum(steps, axis=1)], axis=1)
+    else:
+        raise ValueError(f'Unknown method: {method}')
+    ret[nan] = np.nan
+    return pd.DataFrame(ret, index=ts.index, columns=ts.columns)
+
+
+class SparseTimeseries:
+    """Wide timeseries kept on their reported year grid
+
+    Values are only interpolated to other years, linearly between the
+    reported years of each row and without extrapolation (as
+    `pyam.IamDataFrame.interpolate`), when they are requested through `at`,
+    `interpolate` or `cumulative`.
+    """
+
+    def __init__(self, ts):
+        ts = ts.dropna(how='all').dropna(axis=1, how='all').sort_index().sort_index(axis=1)
+        self.index = ts.index
+        self.years = np.asarray(ts.columns, dtype=float)
+        self.values = ts.to_numpy(dtype=float)
+
+    def __len__(self):
+        return len(self.index)
+
+    @property
+    def frame(self):
+        """The reported values as a wide frame"""
+        return pd.DataFrame(self.values, index=self.index, columns=self.years.astype(int))
+
+    def filter(self, **kwargs):
+        """Rows matching `kwargs` as per `pandas_indexing.ismatch`"""
+        return SparseTimeseries(self.frame.loc[ismatch(**kwargs)])
+
+    def _interpolate(self, rows, years):
+        """(len(rows), len(years)) values interpolated in `years` for each of `rows`"""
+        values = self.values[rows]
+        n, t = values.shape
+        finite = np.isfinite(values)
+        cols = np.arange(t)
+        prev = np.maximum.accumulate(np.where(finite, cols, -1), axis=1)
+        next = np.minimum.accumulate(np.where(finite, cols, t)[:, ::-1], axis=1)[:, ::-1]
+
+        years = np.broadcast_to(np.asarray(years, dtype=float), (n, np.shape(years)[-1]))
+        r = np.arange(n)[:, None]
+        below = np.searchsorted(self.years, years, side='right') - 1
+        above = np.searchsorted(self.years, years, side='left')
+        lo = np.where(below >= 0, prev[r, np.clip(below, 0, t - 1)], -1)
+        hi = np.where(above < t, next[r, np.clip(above, 0, t - 1)], t)
+        valid = (lo >= 0) & (hi < t)
+        lo, hi = np.clip(lo, 0, t - 1), np.clip(hi, 0, t - 1)
+
+        y0, y1 = self.years[lo], self.years[hi]
+        v0, v1 = values[r, lo], values[r, hi]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            ret = np.where(hi == lo, v0, v0 + (v1 - v0) * (years - y0) / (y1 - y0))
+        return np.where(valid, ret, np.nan)
+
+    def at(self, years, chunksize=None):
+        """Wide frame of values interpolated to `years`"""
+        years = np.asarray(years)
+        chunksize = chunksize or max(len(self), 1)
+        values = np.concatenate([
+            self._interpolate(slice(i, i + chunksize), years)
+            for i in range(0, len(self), chunksize)
+        ]) if len(self) else np.empty((0, len(years)))
+        return pd.DataFrame(values, index=self.index, columns=years.astype(int))
+
+    @profiled
+    def interpolate(self, years, chunksize=None):
+        """Wide frame of the reported values, interpolated to `years`
+
+        Like `pyam.IamDataFrame.interpolate`, reported years which are not in
+        `years` are kept as they are.
+        """
+        ret = self.at(years, chunksize=chunksize)
+        native = self.frame.drop(columns=ret.columns, errors='ignore')
+        return pd.concat([native, ret], axis=1).sort_index(axis=1)
+
+    @profiled
+    def cumulative(self, start, end, chunksize=10_000, **kwargs):
+        """Cumulative values from `start` to each year up to `end`, see `cumulate`
+
+        Annual values are only evaluated for `chunksize` rows at a time.
+        """
+        years = np.arange(start, end + 1)
+        return pd.concat([
+            cumulate(
+                pd.DataFrame(self._interpolate(slice(i, i + chunksize), years), columns=years),
+                start=start,
+                end=end,
+                **kwargs,
+            ).set_axis(self.index[i:i + chunksize])
+            for i in range(0, len(self), chunksize)
+        ])
+
+
+# Scenario ensembles
+
+class Ensemble:
+    """Lazy queries on a frame of scenario results and its scenario metadata
+
+    `ts` is any frame whose index includes Model and Scenario, `meta` is
+    indexed by (model, scenario). Index levels and meta columns are integer
+    coded once on first use; `filter`, `exclude` and `dropna` only combine
+    boolean masks over those codes and return new ensembles sharing them.
+    Data is only materialised for the selected rows by `frame`.
+
+        >>> ens = Ensemble(cdf, meta)
+        >>> ens.filter(Region='World', Category=['C1', 'C2']).frame(2100, meta=['Category'])
+    """
+
+    def __init__(self, ts, meta=None):
+        self.ts = ts
+        self.meta = meta
+        self.mask = np.ones(len(ts), dtype=bool)
+        self._coded = {}
+        self._rows = None
+        if meta is not None:
+            keys = pd.MultiIndex.from_arrays([ts.index.get_level_values(l) for l in ['Model', 'Scenario']])
+            self._rows = meta.index.get_indexer(keys)
+
+    def __len__(self):
+        return int(self.mask.sum())
+
+    def codes(self, name):
+        """Codes of the index level or meta column `name` for all rows (-1 if missing) and their labels"""
+        if name not in self._coded:
+            if name in self.ts.index.names:
+                codes, labels = pd.factorize(self.ts.index.get_level_values(name))
+            else:
+                meta_codes, labels = pd.factorize(self.meta[name])
+                codes = np.where(self._rows >= 0, meta_codes[self._rows], -1)
+            self._coded[name] = codes, pd.Index(np.asarray(labels, dtype=object))
+        return self._coded[name]
+
+    def _select(self, mask):
+        ens = copy.copy(self)
+        ens.mask = self.mask & mask
+        return ens
+
+    def _matches(self, name, pattern):
+        codes, labels = self.codes(name)
+        return np.isin(codes, np.flatnonzero(ismatch(labels, pattern).to_numpy()))
+
+    def filter(self, **kwargs):
+        """Rows whose levels or meta columns match the patterns in `kwargs` (as `ismatch`)"""
+        mask = np.ones(len(self.ts), dtype=bool)
+        for name, pattern in kwargs.items():
+            mask &= self._matches(name, pattern)
+        return self._select(mask)
+
+    def exclude(self, **kwargs):
+        """Rows whose levels or meta columns match none of the patterns in `kwargs`"""
+        mask = np.ones(len(self.ts), dtype=bool)
+        for name, pattern in kwargs.items():
+            mask &= ~self._matches(name, pattern)
+        return self._select(mask)
+
+    def dropna(self, *names):
+        """Rows with a value for all levels or meta columns `names`"""
+        return self._select(np.logical_and.reduce([self.codes(name)[0] >= 0 for name in names]))
+
+    def frame(self, columns=None, meta=()):
+        """The selected rows of `columns` (all by default) joined with the `meta` columns"""
+        rows = np.flatnonzero(self.mask)
+        df = self.ts.iloc[rows] if columns is None else self.ts.iloc[rows][columns]
+        if meta:
+            df = df.to_frame() if isinstance(df, pd.Series) else df.copy()
+            meta_rows = self._rows[rows]
+            values = self.meta[list(meta)].iloc[np.where(meta_rows >= 0, meta_rows, 0)]
+            for name in meta:
+                df[name] = values[name].where(meta_rows >= 0).array
+        return df
+
+
+# Distribution summaries
+
+@profiled
+def kde_stats(df, value, by, gridsize=100, bw_adjust=1, chunksize=10_000):
+    """Gaussian KDE of `value` in each group of `df` by `by` on a grid of
+    `gridsize` points between the group minimum and maximum
+
+    The bandwidth follows Scott's rule as in `sns.violinplot(cut=0)`. Groups
+    without spread get a NaN density. The result is indexed by `by` and the
+    grid `point` with columns `support` and `density`, sorted.
+    """
+    grids = {}
+    for key, values in df.groupby(by, sort=False, observed=True)[value]:
+        x = values.dropna().to_numpy(dtype=float)
+        if not len(x):
+            continue
+        support = np.linspace(x.min(), x.max(), gridsize)
+        bw = x.std(ddof=1) * len(x) ** (-1 / 5) * bw_adjust if len(x) > 1 else 0
+        density = np.zeros(gridsize)
+        if bw > 0:
+            for start in range(0, len(x), chunksize):
+                z = (support[:, None] - x[None, start:start + chunksize]) / bw
+                density += np.exp(-0.5 * z ** 2).sum(axis=1)
+            density /= len(x) * bw * np.sqrt(2 * np.pi)
+        else:
+            density[:] = np.nan
+        grids[key] = pd.DataFrame({'support': support, 'density': density}, index=pd.RangeIndex(gridsize, name='point'))
+    return pd.concat(grids, names=by).sort_index()
+
+
+@profiled
+def box_stats(df, value, by, whis=1.5):
+    """Box plot statistics of `value` in each group of `df` by `by`
+
+    Quartiles are linearly interpolated and whiskers reach the furthest value
+    within `whis` times the interquartile range, as in `matplotlib.cbook.boxplot_stats`.
+    """
+    data = df[by + [value]].dropna(subset=[value])
+    grouped = data.groupby(by, sort=False, observed=True)[value]
+    stats = grouped.quantile([0.25, 0.5, 0.75]).unstack()
+    stats.columns = ['q1', 'med', 'q3']
+    reach = whis * (stats['q3'] - stats['q1'])
+    rows = data.join(pd.DataFrame({'lo': stats['q1'] - reach, 'hi': stats['q3'] + reach}), on=by)
+    keys = [rows[level] for level in by]
+    values = rows[value]
+    stats['whislo'] = values.where(values >= rows['lo']).groupby(keys, observed=True).min()
+    stats['whishi'] = values.where(values <= rows['hi']).groupby(keys, observed=True).max()
+    return stats.assign(
+        whislo=stats[['whislo', 'q1']].min(axis=1),
+        whishi=stats[['whishi', 'q3']].max(axis=1),
+        n=grouped.size(),
+    )
+
+
+# Statement facts
+
+def _group_codes(values, levels):
+    index = values.index.droplevel([n for n in values.index.names if n not in levels])
+    if index.nlevels > 1:
+        index = index.reorder_levels(levels)
+    return index.factorize(sort=True)
+
+
+def _sorted_quantiles(x, quantiles):
+    # quantiles along the last axis of sorted values, interpolating linearly
+    pos = np.asarray(quantiles) * (x.shape[-1] - 1)
+    lo, hi = np.floor(pos).astype(int), np.ceil(pos).astype(int)
+    return x[..., lo] + (x[..., hi] - x[..., lo]) * (pos - lo)
+
+
+@profiled
+def grouped_quantiles(values, levels, quantiles=(0.05, 0.25, 0.5, 0.75, 0.95)):
+    """Count, mean and `quantiles` of the Series `values` per group of the index `levels`
+
+    Values are sorted once by group and value and all quantiles of all groups
+    are read off the sorted array, interpolating linearly as
+    `Series.quantile`. Missing values are ignored.
+    """
+    values = values.dropna()
+    codes, groups = _group_codes(values, levels)
+    x = values.to_numpy(dtype=float)
+    x = x[np.lexsort((x, codes))]
+
+    n = np.bincount(codes, minlength=len(groups))
+    start = np.cumsum(n) - n
+    pos = start[:, None] + np.asarray(quantiles)[None, :] * (n[:, None] - 1)
+    lo, hi = np.floor(pos).astype(int), np.ceil(pos).astype(int)
+    result = pd.DataFrame(x[lo] + (x[hi] - x[lo]) * (pos - lo), index=groups, columns=list(quantiles))
+    result.insert(0, 'mean', np.bincount(codes, weights=values.to_numpy(dtype=float), minlength=len(groups)) / n)
+    result.insert(0, 'n', n)
+    return result.rename_axis(index=levels)
+
+
+def _bootstrap_chunk(x, p, quantiles, size, seed):
+    rng = np.random.default_rng(seed)
+    samples = x[rng.choice(len(x), size=(size, len(x)), p=p)]
+    return _sorted_quantiles(np.sort(samples, axis=1), quantiles)
+
+
+@profiled
+def bootstrap_quantiles(
+    values, levels, quantiles=(0.05, 0.5, 0.95), n=1000, weight_by=None, ci=(0.025, 0.975), seed=0,
+    max_cells=2**24, max_workers=None,
+):
+    """Bootstrap `quantiles` of the Series `values` per group of the index `levels`
+
+    The values of each group are resampled with replacement `n` times. With
+    `weight_by` (e.g. `'Model'`) all values of a group sharing that level get
+    the same total probability, so models with many scenarios are not over-
+    represented. Resamples are drawn in chunks of at most `max_cells` values
+    which are spread over a process pool; results only depend on `seed` and
+    `max_cells`.
+
+    Returns per group and quantile the median of the resampled quantile and
+    its `ci` range.
+    """
+    values = values.dropna()
+    codes, groups = _group_codes(values, levels)
+    x = values.to_numpy(dtype=float)
+
+    jobs = []
+    for code in range(len(groups)):
+        rows = np.flatnonzero(codes == code)
+        p = None
+        if weight_by is not None:
+            members = pd.factorize(values.index.get_level_values(weight_by)[rows])[0]
+            p = 1 / np.bincount(members)[members]
+            p /= p.sum()
+        size = max(1, max_cells // len(rows))
+        jobs.extend((code, x[rows], p, min(size, n - start)) for start in range(0, n, size))
+
+    seeds = np.random.SeedSequence(seed).spawn(len(jobs))
+    with ProcessPoolExecutor(max_workers) as pool:
+        futures = [
+            (code, pool.submit(_bootstrap_chunk, xs, p, quantiles, size, s))
+            for (code, xs, p, size), s in zip(jobs, seeds)
+        ]
+        resampled = [[] for _ in groups]
+        for code, future in futures:
+            resampled[code].append(future.result())
+
+    stats = np.stack([np.quantile(np.concatenate(r), [0.5, *ci], axis=0) for r in resampled])
+    index = pd.MultiIndex.from_tuples(
+        [(*(g if isinstance(g, tuple) else (g,)), q) for g in groups for q in quantiles],
+        names=[*levels, 'quantile'],
+    )
+    return pd.DataFrame(stats.transpose(0, 2, 1).reshape(-1, 1 + len(ci)), index=index, columns=['value', *ci])
+
+
+def _json_float(x):
+    return None if pd.isna(x) else float(x)
+
+
+def write_facts(path, summaries, sources=(), value=0.5, bounds=(0.05, 0.95), bootstrap=None):
+    """Write the rows of `summaries` as facts to the json file `path`
+
+    `summaries` maps (column, levels) to tables of `grouped_quantiles`. Each
+    fact holds its group, the `value` quantile, the ensemble 'range' between
+    the `bounds` quantiles and all other statistics. If `bootstrap` maps the
+    same keys to tables of `bootstrap_quantiles`, the confidence intervals
+    ('ci') of the resampled quantiles are added.
+    The sha256 of every file in `sources` is recorded, so facts can be traced
+    to the artifacts they were computed from.
+    """
+    bootstrap = bootstrap or {}
+    facts = []
+    for key, table in summaries.items():
+        column, levels = key
+        for group, row in table.iterrows():
+            group = group if isinstance(group, tuple) else (group,)
+            fact = {
+                'column': column,
+                'group': dict(zip(levels, map(str, group))),
+                'n': int(row['n']),
+                'value': _json_float(row[value]),
+                'range': [_json_float(row[bounds[0]]), _json_float(row[bounds[1]])],
+                'stats': {str(k): _json_float(v) for k, v in row.drop('n').items()},
+            }
+            if key in bootstrap:
+                resampled = bootstrap[key].loc[group]
+                fact['bootstrap'] = {
+                    str(q): {'value': _json_float(r.iloc[0]), 'ci': [_json_float(v) for v in r.iloc[1:]]}
+                    for q, r in resampled.iterrows()
+                }
+            facts.append(fact)
+    sources = {str(f): file_hash(f) for f in sources}
+    Path(path).write_text(json.dumps({'sources': sources, 'facts': facts}, indent=2))
+
+
+# Figures
+
+PLOT_LIBRARIES = ['matplotlib', 'seaborn', 'plotnine', 'pandas', 'numpy']
+
+
+def data_hash(*objs):
+    """Hash of the content of frames, series, arrays and plain values"""
+    h = hashlib.sha256()
+    for obj in objs:
+        if isinstance(obj, (tuple, list)):
+            h.update(data_hash(*obj).encode())
+        elif isinstance(obj, (pd.DataFrame, pd.Series)):
+            columns = obj.columns if isinstance(obj, pd.DataFrame) else [obj.name]
+            h.update(repr((list(obj.index.names), list(columns))).encode())
+            h.update(pd.util.hash_pandas_object(obj, index=True).to_numpy().tobytes())
+        elif isinstance(obj, np.ndarray):
+            h.update(repr((obj.dtype, obj.shape)).encode())
+            h.update(np.ascontiguousarray(obj).tobytes())
+        else:
+            h.update(json.dumps(obj, sort_keys=True, default=str).encode())
+    return h.hexdigest()
+
+
+def library_versions(names=PLOT_LIBRARIES):
+    versions = {}
+    for name in names:
+        try:
+            versions[name] = importlib.metadata.version(name)
+        except importlib.metadata.PackageNotFoundError:
+            pass
+    return versions
+
+
+def figure_params(data, **kwargs):
+    """Cache params of a figure of `data` saved with `kwargs`
+
+    Besides the data they cover the matplotlib rcParams, which carry the
+    seaborn style, and the versions of the plotting libraries.
+    """
+    import matplotlib
+
+    rc = {k: str(v) for k, v in matplotlib.rcParams.items() if k != 'backend'}
+    return {'data': data_hash(data), 'rc': data_hash(rc), 'savefig': kwargs, 'versions': library_versions()}
+
+
+def _source(funcs):
+    return ''.join(_code_hash(func) for func in funcs)
+
+
+@profiled
+def _save_figure(fig, path, **kwargs):
+    if hasattr(fig, 'savefig'):
+        import matplotlib.pyplot as plt
+
+        fig.savefig(path, **kwargs)
+        plt.close(fig)
+    else: # plotnine
+        fig.save(path, verbose=False, **kwargs)
+
+
+def cached_figure(path, build, data, code=(), cache=None, **kwargs):
+    """Save the figure returned by `build()` to `path` unless it is cached
+
+    The key covers `data`, the style (see `figure_params`), the source of
+    `build` and of the plotting functions in `code` and the `savefig` `kwargs`.
+    Works for matplotlib figures and plotnine plots. Returns whether it was a
+    hit.
+    """
+    write = lambda path: _save_figure(build(), path, **kwargs)
+    params = figure_params(data, **kwargs)
+    return cached_artifact(path, write, params=params, code=_source([build, *code]), cache=cache)
+
+
+def draw_violins(ax, kde, quartiles, order, hue_order, palette, width=0.8, linecolor='.3', linewidth=1.25, saturation=0.75):
+    """Split violins with quartile lines drawn from precomputed summaries
+
+    Looks like `sns.violinplot(split=True, inner='quart', cut=0)` with the
+    two `hue_order` levels on the left and right. `kde` and `quartiles` are
+    indexed by (group, hue), see `kde_stats` and `box_stats`. Groups without
+    spread are drawn as a line at their value, fills are desaturated as in
+    seaborn.
+    """
+    from seaborn.utils import desaturate
+
+    peak = kde['density'].groupby(level=1, observed=True).max()
+    colors = {hue: desaturate(palette[hue], saturation) for hue in hue_order}
+    drawn = set()
+    for i, group in enumerate(order):
+        for side, hue in zip((-1, 1), hue_order):
+            if (group, hue) not in quartiles.index:
+                continue
+            drawn.add(hue)
+            grid = kde.loc[(group, hue)]
+            if grid['density'].isna().all():
+                value = grid['support'].iloc[0]
+                ax.plot([i, i + side * width / 2], [value, value], color=linecolor, linewidth=linewidth)
+                continue
+            scale = width / 2 / peak[hue]
+            ax.fill_betweenx(
+                grid['support'], i, i + side * scale * grid['density'],
+                facecolor=colors[hue], edgecolor=linecolor, linewidth=linewidth,
+            )
+            q = quartiles.loc[(group, hue), ['q1', 'med', 'q3']].to_numpy(dtype=float)
+            spans = np.interp(q, grid['support'], grid['density']) * scale
+            for value, span, dashes in zip(q, spans, [(1.25, .75), (2.5, 1), (1.25, .75)]):
+                ax.plot([i, i + side * span], [value, value], color=linecolor, linewidth=linewidth, dashes=dashes)
+
+    # empty fills label each hue drawn, so the legend does not depend on which group comes first
+    for hue in hue_order:
+        if hue in drawn:
+            ax.fill_betweenx([], [], facecolor=colors[hue], edgecolor=linecolor, linewidth=linewidth, label=hue)
+
+    ax.set_xticks(range(len(order)), order)
+    ax.set_xlim(-0.5, len(order) - 0.5)
+    ax.xaxis.grid(False)
+    ax.legend()
+    return ax
+
+
+def draw_boxes(ax, box, order, hue_order, palette, width=0.8, legend=True, title=None, linecolor='.3', saturation=0.75):
+    """Horizontal boxes dodged by hue drawn from precomputed statistics
+
+    Looks like `sns.boxplot(showfliers=False)` with the groups of `order` on
+    the y axis. `box` is indexed by (group, hue), see `box_stats`.
+    """
+    from matplotlib.patches import Patch
+    from seaborn.utils import desaturate
+
+    colors = {hue: desaturate(palette[hue], saturation) for hue in hue_order}
+    dodge = width / len(hue_order)
+    lines = {'color': linecolor}
+    for j, hue in enumerate(hue_order):
+        stats, positions = [], []
+        for i, group in enumerate(order):
+            if (group, hue) in box.index:
+                stats.append(dict(box.loc[(group, hue)], fliers=[]))
+                positions.append(i - width / 2 + dodge * (j + 0.5))
+        if stats:
+            ax.bxp(
+                stats, positions=positions, widths=dodge, capwidths=dodge / 2, orientation='horizontal',
+                showfliers=False, patch_artist=True, manage_ticks=False,
+                boxprops={'facecolor': colors[hue], 'edgecolor': linecolor},
+                medianprops=lines, whiskerprops=lines, capprops=lines,
+            )
+
+    ax.set_yticks(range(len(order)), order)
+    ax.set_ylim(len(order) - 0.5, -0.5)
+    ax.yaxis.grid(False)
+    if legend:
+        ax.legend(handles=[Patch(facecolor=colors[h], edgecolor=linecolor, label=h) for h in hue_order], title=title)
+    return ax
+
+
+def _render(build, args, path, **kwargs):
+    start = time.perf_counter()
+    fig = build(*args)
+    built = time.perf_counter()
+    _save_figure(fig, path, **kwargs)
+    return built - start, time.perf_counter() - built
+
+
+def _render_forked(build, args, path, **kwargs):
+    import matplotlib
+    matplotlib.use('Agg', force=True)
+
+    return _render(build, args, path, **kwargs)
+
+
+def _can_fork():
+    # fork is unavailable on windows and unsafe on macos, where python defaults to spawn
+    return sys.platform not in ('win32', 'darwin') and 'fork' in multiprocessing.get_all_start_methods()
+
+
+def render_figures(figures, data=None, code=(), cache=None, max_workers=None, **kwargs):
+    """Build and save figures in a pool of forked processes with the Agg backend
+
+    `figures` maps output paths to `(build, args)` where `build(*args)` returns
+    a figure. Each path is rendered in its own task, so the formats of one
+    figure are saved in parallel. Workers are forked, so `build` can be defined
+    in and use data of the calling notebook. `kwargs` are passed to `savefig`.
+    Where processes cannot be forked, or with `max_workers=1`, figures are
+    rendered one after the other in the calling process. Each worker holds a
+    full figure in memory, so bound `max_workers` for high `dpi`.
+
+    If `data` maps the paths to the data plotted in them, figures are cached
+    as in `cached_figure` and only rendered when their key changed.
+
+    Returns the build and save time (s) of each figure.
+    """
+    figures = {Path(path): figure for path, figure in figures.items()}
+    data = data and {Path(path): d for path, d in data.items()}
+    todo = {}
+    for path, (build, args) in figures.items():
+        if data is None:
+            todo[path] = None
+            continue
+        store = Path(cache or path.parent / '.cache')
+        store.mkdir(parents=True, exist_ok=True)
+        code_hash = hashlib.sha256(_source([build, *code]).encode()).hexdigest()
+        key, entry = _artifact_key(path, code_hash, params=figure_params(data[path], **kwargs))
+        if not _restore(path, store, key):
+            todo[path] = store, key, entry
+
+    timings = dict.fromkeys(figures, (0., 0.))
+    if max_workers == 1 or not _can_fork():
+        for path in todo:
+            timings[path] = _render(*figures[path], path, **kwargs)
+            if todo[path] is not None:
+                _store(path, *todo[path])
+    else:
+        context = multiprocessing.get_context('fork')
+        with ProcessPoolExecutor(max_workers, mp_context=context) as pool:
+            futures = {path: pool.submit(_render_forked, *figures[path], path, **kwargs) for path in todo}
+            for path, future in futures.items():
+                timings[path] = future.result()
+                if todo[path] is not None:
+                    _store(path, *todo[path])
+
+    return (
+        pd.DataFrame(timings.values(), index=pd.Index(map(str, timings), name='figure'), columns=['build', 'save'])
+        .assign(total=lambda df: df['build'] + df['save'], cached=[path not in todo for path in timings])
+    )
+
+
+if _profile['path'] is not None and 'IPython' in sys.modules:
+    register_cell_hooks()